@@ -56,6 +56,27 @@ import uuid
 import webbrowser
 import functools
 import base64
+import sqlite3
+import tempfile
+import datetime
+import json
+import threading
+import Queue
+import time
+import copy
+import contextlib
+import itertools
+import StringIO
+import socket
+import errno
+import httplib
+import zlib
+import hashlib
+import marshal
+import shutil
+import subprocess
+import shlex
+import importlib
 
 from time import sleep
 
@@ -69,6 +90,105 @@ logging.basicConfig(stream=sys.stdout,
 # This lvel can only be used with logger.log(5, "message")
 logging.addLevelName(5,'HTTPDEBUG')
 
+# HTTP bodies logged on HTTPDEBUG are cut after this many bytes (0: no limit)
+LOG_BODY_SIZE = 2048
+
+def log_body(logger, body):
+    """Logs an HTTP response body on the HTTPDEBUG level. Does nothing if
+    that level is disabled, large bodies are truncated (see LOG_BODY_SIZE).
+    """
+    if logger.isEnabledFor(5):
+        if LOG_BODY_SIZE and len(body) > LOG_BODY_SIZE:
+            logger.log(5, "%s... [%d more bytes]", body[:LOG_BODY_SIZE],
+                       len(body) - LOG_BODY_SIZE)
+        else:
+            logger.log(5, body)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats every log record as a JSON object on a single line. Values
+    passed to the logger with extra={...} are added as fields."""
+
+    _standard = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__)
+    _standard.update(('message', 'asctime'))
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.utcfromtimestamp(
+                record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'function': record.funcName,
+            'thread': record.threadName,
+            }
+        for key, value in record.__dict__.iteritems():
+            if key not in self._standard:
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        try:
+            return json.dumps(data, default=str)
+        except UnicodeDecodeError:
+            # Not UTF-8, most likely a HTML page
+            return json.dumps(data, default=str, encoding='latin-1')
+
+
+class QueueHandler(logging.Handler):
+    """A handler that passes the records to a background thread which
+    feeds them into the target handler, so slow handlers (like the log
+    file) never block the caller. If the queue is full, records are
+    dropped instead of waiting."""
+
+    def __init__(self, target, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.dropped = 0
+        self.queue = Queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name='logwriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            # The message is built now, the arguments may change later
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = self.target.formatter.formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        """Background thread that writes the queued records."""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.target.handle(record)
+
+    def close(self):
+        """Writes the remaining records and closes the target handler."""
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        if self.dropped:
+            self.target.handle(logging.LogRecord(
+                'log', logging.WARNING, __file__, 0,
+                "%d log records dropped", (self.dropped,), None))
+            self.dropped = 0
+        self.target.close()
+        logging.Handler.close(self)
+
 def gdelay(odelay):
     """This method waits a random time if odelay == True.
     Please note this is best used with functools.partial
@@ -204,7 +324,7 @@ def rename(source, dest, *args, **kwargs):
     try:
         os.rename(source, dest, *args, **kwargs)
         logger.info("Renaming {0} to {1}".format(source, dest))
-    except WindowsError:
+    except OSError:
         logger.exception('Renaming {0} to {1} failed'.format(source, dest))
 
 
@@ -215,12 +335,51 @@ def remove(path, *args, **kwargs):
     logger = logging.getLogger('tool.remove')
     try:
         os.remove(path, *args, **kwargs)
-        logger.debug("Removing %s" % path)
-    except WindowsError:
-        logger.exception('Removing %s failed' % path)
+        logger.debug("Removing %s", path)
+    except OSError:
+        logger.exception('Removing %s failed', path)
+
+def read_sections(parser, prefix):
+    """Returns a list of (name, settings) tuples for every [PREFIX NAME]
+    section of a ConfigParser (like [Account NAME] or [Hook NAME]), in the
+    order of the file."""
+    sections = []
+    for section in parser.sections():
+        if section.startswith(prefix + ' '):
+            sections.append((section[len(prefix) + 1:].strip(),
+                             dict(parser.items(section, raw=True))))
+    return sections
+
+def console_stream(opts):
+    """Returns the stream for console output, stderr if stdout is taken by
+    the event stream (--events -)."""
+    return sys.stderr if getattr(opts, 'events', None) == '-' else sys.stdout
+
+def account_options(opts):
+    """Builds the options of every account from the global options and its
+    [Account NAME] section. Asks for missing passwords."""
+    logger = logging.getLogger('cmdline')
+    result = []
+    for name, settings in opts.accountlist:
+        aopts = copy.copy(opts)
+        aopts.outputdir = os.path.join(opts.outputdir, name)
+        aopts.password = None
+        for key, value in settings.iteritems():
+            setattr(aopts, key, value)
+        if 'b64password' in settings:
+            aopts.password = base64.b64decode(settings['b64password'])
+        if not settings.get('username'):
+            logger.error("Account %s has no username, skipped.", name)
+            continue
+        if not aopts.password:
+            aopts.password = getpass.getpass("\nPassword for %s: "
+                                             % aopts.username)
+            print >>console_stream(opts), ''
+        result.append((name, aopts))
+    return result
 
-def optparse_setup():
-    """Parsing options given to PqDL, should be called from main()"""
+def build_parser():
+    """Builds the optparse.OptionParser with all options of PqDL."""
     desc = __doc__
     epilog = """This tool probably violates the Terms of Service by Groundspeak.
 Please don't abuse it. If any argument (username, password, PQ names, ...)
@@ -236,7 +395,6 @@ contains spaces, put it into parantheses. """
                                    epilog=epilog,
                                    usage=usage)
 
-    logger = logging.getLogger('cmdline')
     # Using an empty group as help text
     grp_prm = optparse.OptionGroup(parser, "Arguments", description=
 """Pass the names of the Pocket Queries you want to download as parameters
@@ -248,11 +406,6 @@ with -d -l to get the friendly name or other parameters.""")
 
     parser.add_option_group(grp_prm)
 
-    def print_help(*args, **kwargs):
-        """Handler for print_help that does prints a newline after the text"""
-        parser.print_help(*args, **kwargs)
-        print '\n'
-
     # Core options
     parser.add_option('-u', '--username', help="Username on GC.com "
                       "(use parentheses if it contains spaces)")
@@ -305,12 +458,59 @@ with -d -l to get the friendly name or other parameters.""")
                       "in the output (-o) path.",
                       default="pqdl.ini")
 
+    # Account options
+    grp_acc = optparse.OptionGroup(parser, "Multiple accounts",
+"""PqDL can process several GC.com accounts at once. Every account needs a
+section [Account NAME] in pqdl.ini (or the file given with --accounts) that
+contains username and password (or b64password) and optionally any other
+option like in [Options], for example outputdir or journalfile. The default
+output dir of an account is a subfolder NAME of -o. All accounts run at the
+same time and share the connection and rate limits.""")
+    grp_acc.add_option('--accounts', help="File with [Account NAME] sections "
+                       "[default: pqdl.ini]")
+    grp_acc.add_option('--connections', help="Maximum number of simultaneous "
+                       "connections to GC.com, 0 for no limit "
+                       "[default: %default]", default=4, type='int')
+    grp_acc.add_option('--ratelimit', help="Maximum number of requests per "
+                       "second to GC.com, 0 for no limit [default: %default]",
+                       default=0, type='float')
+    grp_acc.add_option('--bwlimit', help="Maximum bandwidth of all downloads "
+                       "together in bytes per second, like 500k or 2M, 0 for "
+                       "no limit. Time-of-day limits can be set in the "
+                       "[Bandwidth] section of pqdl.ini, as example "
+                       "0800-1830 = 200k, 100k (all downloads, every "
+                       "download). [default: %default]", default='0')
+    grp_acc.add_option('--bwtransfer', help="Maximum bandwidth of every "
+                       "single download, like --bwlimit [default: %default]",
+                       default='0')
+    parser.add_option_group(grp_acc)
+
+    # Retry options
+    grp_retry = optparse.OptionGroup(parser, "Retry options",
+"""Requests and downloads that fail because of a timeout, a server error or
+a lost connection are tried again with growing pauses. PQs that still fail
+are tried once more at the end of the run. After five requests in a row that
+failed even after their retries, PqDL pauses all requests for five minutes.""")
+    grp_retry.add_option('--retries', help="How often a failed request or "
+                         "download is tried again [default: %default]",
+                         default=3, type='int')
+    grp_retry.add_option('--backoff', help="Seconds to wait before the first "
+                         "retry, doubled for every further one "
+                         "[default: %default]", default=2, type='float')
+    grp_retry.add_option('--timeout', help="Timeout for every request in "
+                         "seconds [default: %default]", default=60,
+                         type='float')
+    parser.add_option_group(grp_retry)
+
     # ZIP options
     grp_zip = optparse.OptionGroup(parser, "ZIP options",
 """PqDL supports unzipping the Pocket Queries. They will be renamed
 automatically after unzipping by this pattern:
 Name-of-PQ_1234567_06-12-2010[_waypoints].gpx (-s will be used). Note: if you
-want to your PQs with GSAK or pqloader, there's no need to unzip them!""")
+want to your PQs with GSAK or pqloader, there's no need to unzip them!
+If pqdl.ini contains a [Filter] section, the unzipped PQs will be trimmed by it
+(settings: home=LAT,LON, radius=KM, difficulty=1-3, terrain=1-5,
+exclude=Type 1, Type 2). Filtering requires NumPy.""")
 
     grp_zip.add_option('-z', '--unzip', help="Unzips and removes the "
                        "downloaded ZIP files.", default=False,
@@ -318,8 +518,36 @@ want to your PQs with GSAK or pqloader, there's no need to unzip them!""")
     grp_zip.add_option('--keepzip', help="Do not remove unzipped files. "
                        "(to be used with -z)", default=False,
                        action='store_true')
+    grp_zip.add_option('--merge', help="Merge all PQs unzipped in this run "
+                       "into MERGE.gpx and MERGE_waypoints.gpx. Caches that "
+                       "are in more than one PQ are only written once, the "
+                       "newest PQ wins. (to be used with -z)")
+    grp_zip.add_option('--ggz', help="Write a GGZ file (indexed GPX archive "
+                       "for Garmin devices) for every unzipped PQ. "
+                       "(to be used with -z)", default=False,
+                       action='store_true')
+    grp_zip.add_option('--ggzcombine', help="Combine all PQs unzipped in this "
+                       "run into GGZCOMBINE.ggz, the newest PQ wins. "
+                       "(to be used with -z)")
     parser.add_option_group(grp_zip)
 
+    # Post-processing options
+    grp_hook = optparse.OptionGroup(parser, "Post-processing options",
+"""Every [Hook NAME] section of pqdl.ini is run for each PQ as soon as its
+files are final, while the other PQs are still downloading. A section has
+either command=program arguments (placeholders like {gpxfile}, {wptfile},
+{realfilename}, {ggzfile}, {name} or {date} are replaced by the values of the
+PQ) or callable=module:function (called with the PQ record), and optionally
+timeout=seconds. The hooks of a PQ run one after another in the order of the
+file.""")
+    grp_hook.add_option('--hookworkers', help="Number of PQs post-processed "
+                        "at the same time [default: %default]", default=2,
+                        type='int')
+    grp_hook.add_option('--hookqueue', help="Number of PQs that may wait for "
+                        "post-processing before downloads are paused "
+                        "[default: %default]", default=4, type='int')
+    parser.add_option_group(grp_hook)
+
     # back to core
     parser.add_option('-s', '--singlefile', help="Overwrite existing files. "
                       "When using this option, there won't be any timestamps "
@@ -332,6 +560,28 @@ want to your PQs with GSAK or pqloader, there's no need to unzip them!""")
                       "just list the files. Best to be used with -d.",
                       default=False, action='store_true')
 
+    # Scheduling options
+    grp_sched = optparse.OptionGroup(parser, "Scheduling options",
+"""By default the PQs are downloaded one after another in the order of the
+PQ list. --schedule changes the order: smallest (smallest file first), newest
+(newest generation date first) or priority (as set in the [Priority] section
+of pqdl.ini with PQ=number, higher numbers first, the PQ can be given like in
+the [Map] section). With --deadline, PQs that can't be downloaded in time
+(estimated from the speed so far) are left for the next run and not added to
+the journal.""")
+    grp_sched.add_option('--schedule', help="Download order [default: "
+                         "%default]", default='listing',
+                         choices=('listing', 'smallest', 'newest',
+                                  'priority'))
+    grp_sched.add_option('--parallel', help="Number of PQs downloaded at the "
+                         "same time [default: %default]", default=1,
+                         type='int')
+    grp_sched.add_option('--deadline', help="Don't start downloads that "
+                         "won't finish within this many seconds after the "
+                         "start of the run, 0 for no deadline "
+                         "[default: %default]", default=0, type='float')
+    parser.add_option_group(grp_sched)
+
     # Debug and logging options
     grp_dbg = optparse.OptionGroup(parser, "Logging options", """They are lots
 of debug options. You should always use -d if the program doesn not exactly
@@ -354,6 +604,17 @@ the parser. PLEASE ALWAYS USE -d IF YOU SEND ME A BUG REPORT!""")
     grp_dbg.add_option('--logmode', help="Set the logfile access mode, append "
                        "or overwrite.", default='append', choices=('append',
                                                                    'overwrite'))
+    grp_dbg.add_option('--logformat', help="Format of the logfile, text or "
+                       "json (one JSON object per line) [default: %default]",
+                       default='text', choices=('text', 'json'))
+    grp_dbg.add_option('--logbodysize', help="Truncate HTTP pages logged on "
+                       "HTTPDEBUG after this many bytes, 0 logs them "
+                       "completely [default: %default]", default=2048,
+                       type='int')
+    grp_dbg.add_option('--events', help="Write what PqDL does (PQs listed, "
+                       "changed, downloaded, extracted, removed) as JSON "
+                       "lines to this file or FIFO, - for stdout (the log "
+                       "is written to stderr then)")
     grp_dbg.add_option('--pqsitefile', help="This will replace the PQ listing "
                        "download with a file. This will skip login and PQ site "
                        "fetch, but not the download of the PQs themselves. "
@@ -381,6 +642,23 @@ for the mappings too. The section for this feature is [Log].
                            " journal", default=False, action='store_true')
     grp_journal.add_option('--journalfile', help="Filename of journal file "
                            "[default: %default]", default="filestate.txt")
+    grp_journal.add_option('--statefile', help="File in which PqDL records "
+                           "the progress of every PQ while it runs, so an "
+                           "interrupted run continues where it stopped "
+                           "instead of downloading again. It is removed "
+                           "when the run finishes. [default: %default]",
+                           default="pqdl.state")
+    grp_journal.add_option('--fsync', help="When files are synced to disk: "
+                           "file (every file), batch (all files of a PQ "
+                           "before its progress is recorded in the state "
+                           "file) or never [default: %default]",
+                           default='batch', choices=FileSync.POLICIES)
+    grp_journal.add_option('--listingfile', help="File with a snapshot of "
+                           "the last PQ listing. It's used to report PQs "
+                           "that changed since the last run and to skip "
+                           "parsing a listing that didn't change. Empty to "
+                           "disable [default: %default]",
+                           default="pqdl.listing")
     parser.add_option_group(grp_journal)
 
     # GSAK options
@@ -410,17 +688,207 @@ wildcards yet."""
                        action='store_true')
     parser.add_option_group(grp_map)
 
+    # Cache index options
+    grp_index = optparse.OptionGroup(parser, "Cache index options",
+"""PqDL can keep an index of the caches of all unzipped PQs (the newest
+version of every cache is kept). This index can be searched for caches within
+a radius or a bounding box without logging in, the result will be written as
+a new GPX file. Coordinates are decimal degrees, radius in km. Requires NumPy.
+"""
+)
+    grp_index.add_option('--index', help="Add the unzipped PQs to the cache "
+                         "index (to be used with -z)", default=False,
+                         action='store_true')
+    grp_index.add_option('--indexfile', help="Filename of the cache index "
+                         "[default: %default]", default="cacheindex.db")
+    grp_index.add_option('--near', help="Search the cache index for caches "
+                         "around a point, format: LAT,LON,RADIUS")
+    grp_index.add_option('--bbox', help="Search the cache index for caches in "
+                         "a bounding box, format: MINLAT,MINLON,MAXLAT,MAXLON")
+    grp_index.add_option('--queryout', help="Output file for --near and "
+                         "--bbox [default: %default]", default="query.gpx")
+    parser.add_option_group(grp_index)
+
     # back to core
     parser.add_option('--myfinds', help="Trigger a My Finds Pocket Query if "
                       "possible (you'll most likely need to run this program "
                       "again if the PQ is not generated fast enough, so "
                       "consider using --myfinds with -l)", default=False,
                       action='store_true')
+    return parser
+
+
+def init_ini_options(opts):
+    """Sets the options that only come from pqdl.ini sections (and
+    --accounts) to their empty defaults."""
+    opts.filter = None
+    opts.accountlist = []
+    opts.priority = {}
+    opts.bandwidth = {}
+    opts.hooks = []
+    return opts
+
+def default_options():
+    """Returns the default values of all options without parsing the command
+    line, for using PqDL as a library (see PqSession)."""
+    return init_ini_options(build_parser().get_default_values())
+
+
+def fsync_dir(directory):
+    """Syncs a directory, so renames in it are durable (not on Windows)."""
+    if os.name == 'nt':
+        return
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not supported by every file system
+        pass
+    finally:
+        os.close(fd)
+
+
+class FileSync(object):
+    """The --fsync policy for the files written by AtomicWriter.
+
+    file -- every file is synced before it's renamed into place
+    batch -- the files are synced together by commit(), which the session
+             calls before it records a completed stage of a PQ
+    never -- syncing is left to the operating system
+
+    """
+    POLICIES = ('file', 'batch', 'never')
+
+    def __init__(self, policy='file'):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown fsync policy %s" % policy)
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def closing(self, fileobj):
+        """Called with the flushed temporary file before it's closed."""
+        if self.policy == 'file':
+            os.fsync(fileobj.fileno())
+
+    def renamed(self, path):
+        """Called after a file has been renamed into place."""
+        if self.policy == 'file':
+            fsync_dir(os.path.dirname(os.path.abspath(path)))
+        elif self.policy == 'batch':
+            with self.lock:
+                self.pending.add(os.path.abspath(path))
+
+    def commit(self):
+        """Syncs the files written since the last commit and their
+        directories (batch policy)."""
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        directories = set()
+        for path in pending:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                # Removed in the meantime
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(path))
+        for directory in directories:
+            fsync_dir(directory)
+
+
+class AtomicWriter(object):
+    """A file that is written to a temporary file in the directory of path
+    and renamed over path when it's closed, so path is always either the
+    old or the complete new file.
+
+    Writes go through a buffer of BUFFER_SIZE bytes (a multiple of the page
+    size) and the file is synced by the FileSync given (the file policy by
+    default). Used as a context manager, the temporary file is removed
+    instead if the block raises. Other file methods (tell, seek, ...) are
+    passed to the temporary file, so it can be used for zipfile too.
+
+    """
+    BUFFER_SIZE = 1024 * 1024
+    SUFFIX = '.pqwrite'
+
+    def __init__(self, path, sync=None):
+        self.path = path
+        self.sync = sync or FileSync()
+        self.tmpfile = '%s.%s%s' % (os.path.abspath(path),
+                                    uuid.uuid4().hex[:8], self.SUFFIX)
+        # Created like open() would, so the umask applies
+        fd = os.open(self.tmpfile, os.O_CREAT | os.O_EXCL | os.O_RDWR |
+                     getattr(os, 'O_BINARY', 0), 0666)
+        try:
+            # Keep the mode of the file that is replaced
+            os.chmod(self.tmpfile, os.stat(path).st_mode & 07777)
+        except OSError:
+            pass
+        self.file = os.fdopen(fd, 'w+b', self.BUFFER_SIZE)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        """Writes data to the temporary file."""
+        self.file.write(data)
+
+    def close(self):
+        """Syncs the file (by the policy) and renames it into place."""
+        self.file.flush()
+        self.sync.closing(self.file)
+        self.file.close()
+        if os.name == 'nt' and os.path.isfile(self.path):
+            # rename doesn't replace files on Windows
+            os.remove(self.path)
+        os.rename(self.tmpfile, self.path)
+        self.sync.renamed(self.path)
+
+    def abort(self):
+        """Discards the temporary file, path is left alone."""
+        self.file.close()
+        remove(self.tmpfile)
+
+
+def write_atomic(path, data):
+    """Replaces the content of a file in a crash-safe way: the data is
+    written to a temporary file in the same directory, synced to disk and
+    renamed over the old file, so the file is always either old or new."""
+    with AtomicWriter(path) as outfile:
+        outfile.write(data)
+
+def optparse_setup():
+    """Parsing options given to PqDL, should be called from main()"""
+    parser = build_parser()
+    logger = logging.getLogger('cmdline')
+
+    def print_help():
+        """Handler for print_help that does prints a newline after the text"""
+        parser.print_help(console_stream(opts))
+        print >>console_stream(opts), '\n'
+
     opts, args = parser.parse_args()
 
     # Alternate way to set options, with a pqdl.ini that should be located
     # in the -o or the program file directory.
 
+    init_ini_options(opts)
     if not opts.noini:
 
         oparse = ConfigParser.ConfigParser()
@@ -441,6 +909,63 @@ wildcards yet."""
         if oparse.has_section('Arguments'):
             for setting in oparse.items('Arguments'):
                 args.append(setting[1])
+        # [Filter]
+        # filter settings for the unzipped PQs, see CacheFilter
+        if oparse.has_section('Filter'):
+            opts.filter = dict(oparse.items('Filter'))
+        # [Priority]
+        # PQ=number for --schedule priority, higher numbers first
+        if oparse.has_section('Priority'):
+            opts.priority = dict(oparse.items('Priority'))
+        # [Bandwidth]
+        # HHMM-HHMM=total,transfer limits, see Bandwidth
+        if oparse.has_section('Bandwidth'):
+            opts.bandwidth = dict(oparse.items('Bandwidth', raw=True))
+        # [Hook NAME]
+        # commands or callables run for every PQ, see HookPipeline
+        opts.hooks = read_sections(oparse, 'Hook')
+        if not opts.accounts:
+            opts.accountlist = read_sections(oparse, 'Account')
+    if opts.accounts:
+        oparse = ConfigParser.ConfigParser()
+        oparse.read([opts.accounts])
+        opts.accountlist = read_sections(oparse, 'Account')
+
+    # Keep stdout clean for the event stream, before anything is written
+    if opts.events == '-':
+        for handler in logging.root.handlers:
+            if (isinstance(handler, logging.StreamHandler) and
+                handler.stream is sys.stdout):
+                handler.stream = sys.stderr
+
+    if opts.filter:
+        try:
+            CacheFilter(opts.filter)
+        except ValueError, error:
+            logger.critical("Invalid [Filter] section: %s", error)
+            sys.exit(1)
+
+    for name, settings in opts.hooks:
+        try:
+            HookPipeline.check(settings)
+        except ValueError, error:
+            logger.critical("Invalid [Hook %s] section: %s", name, error)
+            sys.exit(1)
+
+    for key, value in opts.priority.items():
+        try:
+            float(value)
+        except ValueError:
+            logger.critical("Invalid [Priority] entry %s = %s, the priority "
+                            "has to be a number.", key, value)
+            sys.exit(1)
+
+    try:
+        Bandwidth.from_options(opts)
+    except ValueError, error:
+        logger.critical("Invalid [Bandwidth] section or bandwidth option: %s",
+                        error)
+        sys.exit(1)
 
     # Check if base64-encoded password is specified, if yes, replace the
     # password field with it.
@@ -450,8 +975,12 @@ wildcards yet."""
         except ValueError:
             logger.error('Base64 password not valid!')
 
+    # Index queries work offline
+    query = opts.near or opts.bbox
+
     # If no simulation, require username
-    if not opts.username and not opts.pqsitefile:
+    if (not opts.username and not opts.pqsitefile and not query
+        and not opts.accountlist):
         print_help()
         logger.critical("Please specify a username, I won't use mine :-)")
         sys.exit(1)
@@ -463,13 +992,14 @@ wildcards yet."""
         opts.mapfile = opts.journalfile
 
     # If no simulation and password, request it.
-    if not opts.password and not opts.pqsitefile:
+    if (not opts.password and not opts.pqsitefile and not query
+        and not opts.accountlist):
         opts.password = getpass.getpass("\nPassword for %s: " % opts.username)
-        print ''
+        print >>console_stream(opts), ''
 
     # The password should be available now, so let's check if the user
     # requested it encoded to base64.
-    if opts.getb64:
+    if opts.getb64 and opts.password:
         logger.info("Password as base64: %s",
                     base64.b64encode(opts.password))
 
@@ -486,6 +1016,38 @@ wildcards yet."""
         logger.critical("You can't use --keepzip without -z (--unzip).")
         sys.exit(1)
 
+    # Merging works on the unzipped GPX files only.
+    if opts.merge and not opts.unzip:
+        print_help()
+        logger.critical("You can't use --merge without -z (--unzip).")
+        sys.exit(1)
+
+    if (opts.ggz or opts.ggzcombine) and not opts.unzip:
+        print_help()
+        logger.critical("You can't use --ggz or --ggzcombine without -z "
+                        "(--unzip).")
+        sys.exit(1)
+
+    if opts.index and not opts.unzip:
+        print_help()
+        logger.critical("You can't use --index without -z (--unzip).")
+        sys.exit(1)
+
+    # --near LAT,LON,KM and --bbox MINLAT,MINLON,MAXLAT,MAXLON
+    for option, count in (('near', 3), ('bbox', 4)):
+        value = getattr(opts, option)
+        if not value:
+            continue
+        try:
+            numbers = [float(x) for x in value.split(',')]
+        except ValueError:
+            numbers = []
+        if len(numbers) != count:
+            print_help()
+            logger.critical("--%s needs %d comma separated numbers, not %s",
+                            option, count, value)
+            sys.exit(1)
+
     # Shortcut for debug logging
     if opts.debug:
         level = logging.DEBUG
@@ -509,10 +1071,17 @@ wildcards yet."""
                                           mode = ('a' if
                                                   opts.logmode == 'append'
                                                   else 'w'))
-        filehandler.formatter = logging.Formatter(
-            "%(module)s line %(lineno)d - %(asctime)s - %(levelname)s - \
-            %(funcName)s - %(name)s - %(message)s")
-        logging.root.addHandler(filehandler)
+        if opts.logformat == 'json':
+            filehandler.formatter = JsonFormatter()
+        else:
+            filehandler.formatter = logging.Formatter(
+                "%(module)s line %(lineno)d - %(asctime)s - %(levelname)s - \
+                %(funcName)s - %(name)s - %(message)s")
+        # The file is written by a background thread
+        logging.root.addHandler(QueueHandler(filehandler))
+
+    global LOG_BODY_SIZE
+    LOG_BODY_SIZE = int(opts.logbodysize)
 
     return opts, args
 
@@ -530,6 +1099,168 @@ class LoginError(PqDLError):
     """Wrong password error."""
     pass
 
+class CircuitOpenError(PqDLError):
+    """GC.com failed too often, requests are not sent for a while."""
+    pass
+
+
+class PqRecord(object):
+    """A Pocket Query of the listing and the files made from it.
+
+    The schema is fixed: LISTING are the fields parsed from the PQ site
+    (see PqBrowser.get_link_db()), PIPELINE the ones set while a PQ is
+    processed. All values are strings or None (unset). Records work like
+    the dictionaries they replace (link['name'], link.get('gpxfile'),
+    '{name}'.format(**link)), but unknown fields raise a KeyError.
+
+    """
+    LISTING = ('type', 'index', 'url', 'name', 'friendlyname', 'size',
+               'count', 'date', 'chkdelete')
+    PIPELINE = ('filename', 'mapstr', 'realfilename', 'gpxfile', 'wptfile',
+                'ggzfile', 'stage')
+    __slots__ = LISTING + PIPELINE
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, None)
+        for field, value in fields.iteritems():
+            self[field] = value
+
+    def __getitem__(self, field):
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        if field not in self.__slots__:
+            raise KeyError("%s is not a PQ record field" % field)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.__slots__ and getattr(self, field) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return 'PqRecord(%s)' % ', '.join('%s=%r' % item
+                                          for item in self.iteritems())
+
+    def get(self, field, default=None):
+        """Like dict.get()."""
+        if field not in self.__slots__:
+            return default
+        value = getattr(self, field)
+        return default if value is None else value
+
+    def keys(self):
+        """Returns the fields that are set."""
+        return [field for field in self.__slots__
+                if getattr(self, field) is not None]
+
+    def iteritems(self):
+        """Yields the (field, value) pairs that are set."""
+        for field in self.keys():
+            yield field, getattr(self, field)
+
+    def to_tuple(self, fields=None):
+        """Returns the values of fields (all by default) as a tuple."""
+        values = []
+        for field in fields or self.__slots__:
+            value = getattr(self, field)
+            # marshal only handles the exact built-in types
+            values.append(None if value is None else
+                          unicode(value) if isinstance(value, unicode) else
+                          str(value))
+        return tuple(values)
+
+    @classmethod
+    def from_tuple(cls, values, fields=None):
+        """Creates a record from to_tuple() output."""
+        record = cls()
+        for field, value in zip(fields or cls.__slots__, values):
+            setattr(record, field, value)
+        return record
+
+    def pack(self):
+        """Returns the record as a compact binary string."""
+        return marshal.dumps(self.to_tuple())
+
+    @classmethod
+    def unpack(cls, data):
+        """Creates a record from pack() output."""
+        return cls.from_tuple(marshal.loads(data))
+
+    def to_json(self):
+        """Returns the fields that are set as a JSON object."""
+        return json.dumps(dict(self.iteritems()))
+
+    @classmethod
+    def from_json(cls, data):
+        """Creates a record from to_json() output."""
+        return cls(**dict((str(field), value) for field, value in
+                          json.loads(data).iteritems()))
+
+
+class ListingSnapshot(object):
+    """The PQ listing of the last run, saved as a marshal file.
+
+    Besides the LISTING fields of every record it stores a digest of the
+    PQ rows of the page (see digest()), so an unchanged listing doesn't
+    have to be parsed again. A missing or unreadable file is an empty
+    snapshot.
+
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.listing_digest = None
+        self.records = []
+        try:
+            with open(path, 'rb') as sfile:
+                data = marshal.load(sfile)
+            if data['version'] == self.VERSION:
+                self.listing_digest = data['digest']
+                self.records = data['records']
+        except (IOError, EOFError, ValueError, TypeError, KeyError):
+            pass
+
+    @staticmethod
+    def digest(response, special):
+        """Returns a digest of the PQ rows of a listing page."""
+        start = response.find('trPQDownloadRow')
+        end = response.find('</tr>', response.rfind('trPQDownloadRow'))
+        rows = response[start:end] if start != -1 else ''
+        return hashlib.sha1('%s:%s' % (special, rows)).hexdigest()
+
+    def copy(self):
+        """Returns new PqRecords for the snapshot."""
+        return [PqRecord.from_tuple(values, PqRecord.LISTING)
+                for values in self.records]
+
+    def dates(self):
+        """Returns a dictionary of the PQ dates by chkdelete."""
+        chkdelete = PqRecord.LISTING.index('chkdelete')
+        date = PqRecord.LISTING.index('date')
+        return dict((values[chkdelete], values[date])
+                    for values in self.records)
+
+    def update(self, digest, linklist):
+        """Replaces the snapshot with a new listing."""
+        self.listing_digest = digest
+        self.records = [link.to_tuple(PqRecord.LISTING) for link in linklist]
+
+    def save(self):
+        """Writes the snapshot, see write_atomic()."""
+        write_atomic(self.path, marshal.dumps({
+            'version': self.VERSION, 'digest': self.listing_digest,
+            'records': self.records}))
+
 class PqBrowser(mechanize.Browser):
     """A mechanize.Browser() that provides additional GC.com access features."""
 
@@ -541,6 +1272,7 @@ class PqBrowser(mechanize.Browser):
         # Various options
         cookiejar = cookielib.LWPCookieJar()
         self.set_cookiejar(cookiejar)
+        self.cookiejar = cookiejar
         self.set_handle_equiv(True)
         #self.set_handle_gzip(True)
         self.set_handle_redirect(True)
@@ -561,6 +1293,44 @@ class PqBrowser(mechanize.Browser):
         # Attributes that will be set from outer scope
         self.pqsimulate = False
         self.pqfile = None
+        self.limits = None
+        self.metrics = None
+        self.retry = None
+        self.sync = None
+
+    def clone(self):
+        """Returns a new browser that shares the cookies (and so the login)
+        and the settings of this one, for parallel downloads."""
+        browser = PqBrowser()
+        browser.cookiejar = self.cookiejar
+        browser.set_cookiejar(self.cookiejar)
+        browser.pqsimulate = self.pqsimulate
+        browser.pqfile = self.pqfile
+        browser.limits = self.limits
+        browser.metrics = self.metrics
+        browser.retry = self.retry
+        browser.sync = self.sync
+        return browser
+
+    def open(self, url, *args, **kwargs):
+        """mechanize.Browser.open() that respects the shared limits and
+        retries transient errors (see RetryPolicy). Every request (including
+        submit()) goes through here."""
+        if self.retry is None:
+            return self._open(url, *args, **kwargs)
+        if len(args) < 2 and 'timeout' not in kwargs:
+            kwargs['timeout'] = self.retry.timeout
+        return self.retry.call(self._open, url, *args, **kwargs)
+
+    def _open(self, url, *args, **kwargs):
+        """A single request within the limits."""
+        if self.metrics:
+            self.metrics.add('requests')
+        if self.limits is None:
+            return mechanize.Browser.open(self, url, *args, **kwargs)
+        self.limits.wait()
+        with self.limits.connection():
+            return mechanize.Browser.open(self, url, *args, **kwargs)
 
     def login_gc(self, username, password, urlbase):
         """Login to GC.com site."""
@@ -574,13 +1344,13 @@ class PqBrowser(mechanize.Browser):
         self.form['Password'] = password
         self.submit()
         response = self.response().read()
-        logger.log(5, response)
+        log_body(logger, response)
         if not '/my/default.aspx' in response:
 
             logger.critical("Could not log in. Please check your password. "
                             "If your username or password contains spaces, "
                             "put it into parentheses!")
-            sys.exit(1)
+            raise LoginError(username)
 
     def delete_pqs(self, chkid, ctl):
         """Deletes downloadable PQs with given ids."""
@@ -595,7 +1365,7 @@ class PqBrowser(mechanize.Browser):
                                       "uxDownloadPQList$ctl%s$lnkDeleteSelected"
                                       % ctl)
         self.submit()
-        logger.log(5, self.response().read())
+        log_body(logger, self.response().read())
 
     def trigger_myfinds(self):
         """Request a MyFinds-PocketQuery if available."""
@@ -622,8 +1392,14 @@ class PqBrowser(mechanize.Browser):
         ind = response.index(tmpl)+len(tmpl)
         return response[ind:ind+2]
 
-    def get_link_db(self, special):
-        """Gets the link DB. Requires login first!"""
+    def get_link_db(self, special, snapshot=None):
+        """Gets the link DB as a list of PqRecords. Requires login first!
+
+        If a ListingSnapshot is given and the PQ rows of the listing are
+        the same as in the snapshot, its records are used instead of
+        parsing the page again. The snapshot is updated otherwise.
+
+        """
         logger = logging.getLogger('browser.parser')
         if not self.pqsimulate:
             response = self.open(
@@ -631,14 +1407,19 @@ class PqBrowser(mechanize.Browser):
             if not "/my/default.aspx" in response:
                 logger.error("Invalid PQ site. Not logged in?")
         else:
-            response = open(self.pqfile, 'r')
+            response = open(self.pqfile, 'r').read()
         #f = open('debug.txt')
         #response = f.read()
 
+        digest = ListingSnapshot.digest(response, special)
+        if snapshot is not None and snapshot.listing_digest == digest:
+            logger.debug("PQ listing unchanged, using the snapshot")
+            return snapshot.copy()
+
         soup = BeautifulSoup.BeautifulSoup(response)
         links = soup(id=re.compile("trPQDownloadRow"))
 
-        logger.log(5, response)
+        log_body(logger, response)
 
         linklist = []
         for link in links:
@@ -651,28 +1432,612 @@ class PqBrowser(mechanize.Browser):
                     logger.debug("MyFinds skipped because of -n" )
                     continue
 
-            linklist.append({
-                'type': 'normal',
-                'index': link.contents[3].contents[0].strip().strip('.'),
-                'url': link.contents[5].contents[3]['href'],
-                'name': link.contents[5].contents[3].contents[0].strip(),
-                'friendlyname': slugify(link.contents[5].contents[3].\
-                                        contents[0].strip()),
-                'size': link.contents[7].contents[0].strip(),
-                'count': link.contents[9].contents[0].strip(),
-                'date': link.contents[11].contents[0].strip().split(' ')[0].\
-                                        replace('/','-'),
-                #'preserve': link.contents[11].contents[0].split(' ',1)[1]\
+            linklist.append(PqRecord(
+                type='normal',
+                index=link.contents[3].contents[0].strip().strip('.'),
+                url=link.contents[5].contents[3]['href'],
+                name=link.contents[5].contents[3].contents[0].strip(),
+                friendlyname=slugify(link.contents[5].contents[3].\
+                                     contents[0].strip()),
+                size=link.contents[7].contents[0].strip(),
+                count=link.contents[9].contents[0].strip(),
+                date=link.contents[11].contents[0].strip().split(' ')[0].\
+                                     replace('/','-'),
+                #preserve=link.contents[11].contents[0].split(' ',1)[1]\
                 #[1:-1],
-                'chkdelete': chkdelete,
-            })
+                chkdelete=chkdelete,
+            ))
 
+        if snapshot is not None:
+            snapshot.update(digest, linklist)
         return linklist
 
     def download_pq(self, link, filename, hook):
-        """Retrieve a PQ from an URL and save it"""
+        """Retrieve a PQ from an URL and save it. Works like
+        mechanize.Browser.retrieve(), but reads the response in chunks that
+        pass the bandwidth limits (see Bandwidth). If the transfer fails
+        with a transient error, it is started again."""
+        if self.retry is None:
+            return self._download_pq(link, filename, hook)
+        return self.retry.call(self._download_pq, link, filename, hook)
+
+    def _download_pq(self, link, filename, hook):
+        """A single download attempt."""
         baseurl = 'http://www.geocaching.com'
-        self.retrieve(baseurl+link, filename, hook)
+        limits = self.limits or Limits()
+        bucket = TokenBucket()
+        # The connection is kept while the body is read
+        with limits.connection():
+            response = self.open(baseurl+link)
+            try:
+                headers = response.info()
+                size = int(headers.get('Content-Length', -1))
+                read = 0
+                blocknum = 0
+                hook(blocknum, self.BLOCK_SIZE, size)
+                # An incomplete download never replaces filename
+                with AtomicWriter(filename, self.sync) as outfile:
+                    while True:
+                        block = response.read(self.BLOCK_SIZE)
+                        if not block:
+                            break
+                        if limits.bandwidth:
+                            limits.bandwidth.consume(len(block), bucket)
+                        outfile.write(block)
+                        read += len(block)
+                        blocknum += 1
+                        hook(blocknum, self.BLOCK_SIZE, size)
+                    if size >= 0 and read < size:
+                        raise mechanize.ContentTooShortError(
+                            "retrieval incomplete: got only %i out of %i "
+                            "bytes" % (read, size), (filename, headers))
+            finally:
+                response.close()
+
+
+TRANSIENT_ERRNOS = (errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED,
+                    errno.ETIMEDOUT, errno.EPIPE, errno.EHOSTUNREACH,
+                    errno.ENETUNREACH)
+
+
+class CircuitBreaker(object):
+    """Stops all requests to GC.com for cooldown seconds after threshold
+    requests in a row failed even after their retries, so a site that is
+    down isn't hammered by all downloads and accounts. After the cooldown
+    requests are allowed again; the first success closes the circuit."""
+    def __init__(self, threshold=5, cooldown=300):
+        self.logger = logging.getLogger('browser.circuit')
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+
+    def before(self):
+        """Raises CircuitOpenError if no requests should be sent."""
+        with self.lock:
+            if (self.opened is not None and
+                time.time() - self.opened < self.cooldown):
+                raise CircuitOpenError("GC.com seems to be down, no requests "
+                                       "for %d seconds" % self.cooldown)
+
+    def success(self):
+        """Records a successful request."""
+        with self.lock:
+            if self.opened is not None:
+                self.logger.info("GC.com is reachable again")
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        """Records a request that failed after all retries."""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    self.logger.error("%d failures in a row, pausing all "
+                                      "requests for %d seconds",
+                                      self.failures, self.cooldown)
+                self.opened = time.time()
+
+
+class RetryPolicy(object):
+    """Retries transient errors (timeouts, server errors, lost connections)
+    with exponential backoff and jitter.
+
+    retries -- number of retries after the first attempt
+    backoff -- seconds before the first retry, doubled for every retry
+    timeout -- timeout for a single request in seconds
+    breaker -- CircuitBreaker that is informed about the results, or None
+
+    Nested calls in the same thread (like the request of a download) are
+    not retried on their own, only the outermost call is.
+
+    """
+    def __init__(self, retries=3, backoff=2.0, timeout=60, breaker=None,
+                 maxbackoff=120):
+        self.logger = logging.getLogger('browser.retry')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.breaker = breaker
+        self.maxbackoff = maxbackoff
+        self._local = threading.local()
+
+    def transient(self, error):
+        """Checks if an error is worth a retry."""
+        if isinstance(error, urllib2.HTTPError):
+            return error.code >= 500 or error.code == 429
+        if isinstance(error, mechanize.ContentTooShortError):
+            return True
+        if isinstance(error, urllib2.URLError):
+            error = error.reason
+        if isinstance(error, socket.timeout):
+            return True
+        if isinstance(error, socket.error):
+            return error.errno in TRANSIENT_ERRNOS
+        return isinstance(error, httplib.HTTPException)
+
+    def delay(self, attempt):
+        """Seconds to wait before retry number attempt (from 0)."""
+        delay = min(self.maxbackoff, self.backoff * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def call(self, func, *args, **kwargs):
+        """Calls func and retries it if it raises a transient error."""
+        if getattr(self._local, 'active', False):
+            return func(*args, **kwargs)
+        self._local.active = True
+        try:
+            attempt = 0
+            while True:
+                if self.breaker:
+                    self.breaker.before()
+                try:
+                    result = func(*args, **kwargs)
+                except Exception, error:
+                    if not self.transient(error):
+                        raise
+                    if attempt >= self.retries:
+                        if self.breaker:
+                            self.breaker.failure()
+                        raise
+                    wait = self.delay(attempt)
+                    attempt += 1
+                    self.logger.warning("%s, retry %d/%d in %.1f seconds",
+                                        error, attempt, self.retries, wait)
+                    sleep(wait)
+                else:
+                    if self.breaker:
+                        self.breaker.success()
+                    return result
+        finally:
+            self._local.active = False
+
+
+def parse_rate(rate):
+    """Converts a bandwidth like "256k" or "1.5M" into bytes per second,
+    0 means unlimited."""
+    rate = str(rate).strip().upper().rstrip('B/S')
+    factor = {'K': 1024, 'M': 1024**2, 'G': 1024**3}.get(rate[-1:], 1)
+    if factor != 1:
+        rate = rate[:-1]
+    return int(float(rate or 0) * factor)
+
+
+class TokenBucket(object):
+    """A token bucket for a bandwidth limit in bytes per second (0 means
+    unlimited). It holds at most one second worth of tokens, so short bursts
+    are allowed but the long-term rate is smooth. Consumers that take more
+    than available go into debt and sleep until it's paid back."""
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = 0
+        self.stamp = time.time()
+
+    def set_rate(self, rate):
+        """Changes the rate."""
+        with self.lock:
+            self.rate = rate
+
+    def consume(self, amount):
+        """Takes amount tokens, sleeps if there are not enough."""
+        with self.lock:
+            now = time.time()
+            if not self.rate:
+                self.stamp = now
+                return
+            self.tokens = min(self.rate, self.tokens +
+                              (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            wait = -self.tokens / float(self.rate) if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+class Bandwidth(object):
+    """Bandwidth limits for the PQ downloads: an aggregate limit shared by
+    all transfers and a limit for every single transfer. Both can depend
+    on the time of day, profiles are given as (start, end, total, transfer)
+    with start and end in minutes after midnight; the first profile that
+    contains the current local time wins, otherwise the defaults are used.
+
+    """
+    def __init__(self, total=0, transfer=0, profiles=()):
+        self.default = (total, transfer)
+        self.profiles = list(profiles)
+        self.bucket = TokenBucket()
+        self.transfer = transfer
+        self._checked = 0
+
+    @classmethod
+    def from_options(cls, opts):
+        """Builds the limits from --bwlimit, --bwtransfer and the
+        [Bandwidth] section of pqdl.ini (HHMM-HHMM = total, transfer).
+        Returns None if there are no limits at all, raises ValueError for
+        malformed settings."""
+        def minutes(value):
+            """Converts HHMM or HH into minutes after midnight."""
+            value = value.strip()
+            if not value.isdigit() or len(value) > 4:
+                raise ValueError("%r is not a HHMM time" % value)
+            if len(value) <= 2:
+                value += '00'
+            hours, mins = int(value[:-2]), int(value[-2:])
+            if hours > 24 or mins > 59 or hours * 60 + mins > 1440:
+                raise ValueError("%r is not a HHMM time" % value)
+            return hours * 60 + mins
+
+        def rate(value, name):
+            """parse_rate with a readable error."""
+            try:
+                return parse_rate(value)
+            except ValueError:
+                raise ValueError("%s %r is not a rate like 256k or 1.5M"
+                                 % (name, value))
+
+        profiles = []
+        for key, value in sorted(opts.bandwidth.iteritems()):
+            if '-' not in key:
+                raise ValueError("%r is not a HHMM-HHMM time range" % key)
+            start, end = [minutes(part) for part in key.split('-', 1)]
+            rates = [rate(part, key) for part in value.split(',')]
+            profiles.append((start, end, rates[0], rates[-1]))
+        bandwidth = cls(rate(opts.bwlimit, '--bwlimit'),
+                        rate(opts.bwtransfer, '--bwtransfer'), profiles)
+        if not any(bandwidth.default) and not profiles:
+            return None
+        return bandwidth
+
+    def rates(self, now=None):
+        """Returns the (total, transfer) limits for a time."""
+        now = time.localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, total, transfer in self.profiles:
+            if (start <= minute < end if start <= end
+                else minute >= start or minute < end):
+                return total, transfer
+        return self.default
+
+    def consume(self, amount, bucket):
+        """Waits until amount bytes may be read by the transfer that owns
+        bucket (a TokenBucket)."""
+        now = time.time()
+        if now - self._checked >= 60:
+            self._checked = now
+            total, self.transfer = self.rates(now)
+            self.bucket.set_rate(total)
+        if bucket.rate != self.transfer:
+            bucket.set_rate(self.transfer)
+        bucket.consume(amount)
+        self.bucket.consume(amount)
+
+
+class Limits(object):
+    """Limits shared by all browsers of a run: the number of simultaneous
+    connections and the number of requests per second (0 disables them),
+    the download bandwidth (a Bandwidth instance or None) and the
+    CircuitBreaker for GC.com (or None).
+
+    connection() is reentrant within a thread, so a download that holds a
+    connection can open its request without waiting for a second one.
+
+    """
+    def __init__(self, connections=0, rate=0, bandwidth=None, breaker=None):
+        self.bandwidth = bandwidth
+        self.breaker = breaker
+        self.slots = (threading.Semaphore(connections) if connections
+                      else None)
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def wait(self):
+        """Blocks until the next request may be sent."""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            sleep(start - now)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager that holds one of the connection slots."""
+        depth = getattr(self._local, 'depth', 0)
+        if self.slots and not depth:
+            self.slots.acquire()
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if self.slots and not depth:
+                self.slots.release()
+
+
+class Metrics(object):
+    """Thread-safe counters for a run, logged at the end."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.started = time.time()
+
+    def add(self, name, value=1):
+        """Increments a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        """Returns the value of a counter."""
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def log(self):
+        """Writes all counters to the log."""
+        logger = logging.getLogger('main.metrics')
+        with self.lock:
+            counters = sorted(self.counters.iteritems())
+        logger.info("Run took %s: %s", format_time(time.time() - self.started),
+                    ", ".join(("%s %.1f" if isinstance(value, float)
+                               else "%s %s") % (name, value)
+                              for name, value in counters) or "nothing done")
+
+
+class EventStream(object):
+    """Writes what PqDL does as JSON lines (one object per event) to a file,
+    a FIFO or stdout ('-'), so other programs can follow a run while it
+    goes on. Without a target, events are dropped.
+
+    Every event has the keys event and time (and account for the events of
+    a session). Events about a PQ contain the fields of its link (see
+    PqBrowser.get_link_db()) as well. The events are listed, changed,
+    download_started, download_progress, download_finished,
+    download_failed, stored, extracted, removed and hook_finished.
+
+    """
+    def __init__(self, target=None, interval=1.0):
+        """Inits the stream.
+
+        target -- filename, FIFO or '-' for stdout, or None
+        interval -- minimum seconds between the download_progress events of
+                    a download
+
+        """
+        self.logger = logging.getLogger('main.events')
+        self.interval = interval
+        self.lock = threading.Lock()
+        if not target:
+            self._file = None
+        elif target == '-':
+            self._file = sys.stdout
+        else:
+            # Blocks until a reader opens a FIFO
+            self._file = open(target, 'a')
+
+    def emit(self, event, link=None, **fields):
+        """Writes an event. fields are added to the fields of link."""
+        if self._file is None:
+            return
+        record = dict(link or {})
+        record.update(fields)
+        record['event'] = event
+        record['time'] = datetime.datetime.utcnow().isoformat() + 'Z'
+        line = json.dumps(record, sort_keys=True, default=str)
+        with self.lock:
+            if self._file is None:
+                return
+            try:
+                self._file.write(line + '\n')
+                self._file.flush()
+            except IOError, error:
+                # Most likely the reader of a FIFO went away
+                self.logger.warning("Event stream closed: %s", error)
+                self._file = None
+
+    def hook(self, reporthook, link, **fields):
+        """Wraps a reporthook (see Progress.hook()) so it emits
+        download_progress events for link as well."""
+        if self._file is None:
+            return reporthook
+        state = {'last': 0}
+        def eventhook(count, blocksize, totalsize):
+            reporthook(count, blocksize, totalsize)
+            now = time.time()
+            if now - state['last'] >= self.interval:
+                state['last'] = now
+                done = count * blocksize
+                if totalsize > 0:
+                    done = min(done, totalsize)
+                self.emit('download_progress', link, bytes=done,
+                          total=totalsize if totalsize > 0 else None,
+                          **fields)
+        return eventhook
+
+    def close(self):
+        """Closes the target (unless it's stdout)."""
+        with self.lock:
+            if self._file is not None and self._file is not sys.stdout:
+                self._file.close()
+            self._file = None
+
+
+_SIZE_RE = re.compile(r'([0-9.,]+)\s*([KMG]?B)', re.I)
+_SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3}
+
+def parse_size(size):
+    """Converts a size like "1.23 MB" (as in link['size']) into bytes.
+    Returns None if the size is unknown."""
+    match = _SIZE_RE.search(size or '')
+    if not match:
+        return None
+    try:
+        value = float(match.group(1).replace(',', ''))
+    except ValueError:
+        return None
+    return int(value * _SIZE_UNITS[match.group(2).upper()])
+
+def format_size(size):
+    """Formats a byte count for humans."""
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GB" % size
+
+def format_time(seconds):
+    """Formats a duration as [h:]mm:ss, '?' if unknown."""
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
+
+
+class Progress(object):
+    """Progress display for any number of (concurrent) transfers.
+
+    Transfers are registered with start() and report the bytes they have
+    read with update() or through a mechanize reporthook from hook(). The
+    updates only change counters; the display is redrawn at most every
+    interval seconds as a single status line. If the output is not a
+    terminal, a log line is written every loginterval seconds instead.
+
+    """
+    def __init__(self, interval=0.5, loginterval=30, stream=sys.stdout):
+        self.logger = logging.getLogger('main.progress')
+        self.stream = stream
+        self.tty = hasattr(stream, 'isatty') and stream.isatty()
+        self.interval = interval if self.tty else loginterval
+        self.lock = threading.Lock()
+        self.transfers = {}
+        self.finished = 0
+        self.finishedbytes = 0
+        self.started = None
+        self._lastdraw = 0
+        self._width = 0
+
+    def start(self, key, name, total=None):
+        """Registers a new transfer, total is the expected size or None."""
+        with self.lock:
+            now = time.time()
+            if self.started is None:
+                self.started = now
+            self.transfers[key] = {'name': name, 'total': total, 'done': 0,
+                                   'started': now}
+
+    def update(self, key, done, total=None):
+        """Sets the number of bytes a transfer has read so far."""
+        with self.lock:
+            transfer = self.transfers[key]
+            transfer['done'] = done
+            if total:
+                transfer['total'] = total
+            now = time.time()
+            if now - self._lastdraw >= self.interval:
+                self._lastdraw = now
+                self._draw(now)
+
+    def hook(self, key):
+        """Returns a reporthook for mechanize.Browser.retrieve()."""
+        def reporthook(count, blocksize, totalsize):
+            done = count * blocksize
+            if totalsize > 0:
+                done = min(done, totalsize)
+            self.update(key, done, totalsize if totalsize > 0 else None)
+        return reporthook
+
+    def finish(self, key, failed=False):
+        """Removes a finished (or failed) transfer from the display."""
+        with self.lock:
+            transfer = self.transfers.pop(key)
+            self._clear()
+            if failed:
+                self.logger.info("%s failed after %s", transfer['name'],
+                                 format_size(transfer['done']))
+                return
+            self.finished += 1
+            self.finishedbytes += transfer['done']
+            duration = max(time.time() - transfer['started'], 1e-3)
+            self.logger.info("%s done (%s, %s/s)", transfer['name'],
+                             format_size(transfer['done']),
+                             format_size(transfer['done'] / duration))
+
+    def rates(self, now=None):
+        """Returns the aggregate bytes done, bytes per second and ETA."""
+        now = now or time.time()
+        done = self.finishedbytes + sum(transfer['done'] for transfer in
+                                        self.transfers.itervalues())
+        rate = done / max(now - (self.started or now), 1e-3)
+        remaining = sum(transfer['total'] - transfer['done'] for transfer in
+                        self.transfers.itervalues() if transfer['total'])
+        eta = remaining / rate if rate else None
+        return done, rate, eta
+
+    def _draw(self, now):
+        """Shows the current state, needs the lock."""
+        parts = []
+        for transfer in self.transfers.itervalues():
+            rate = transfer['done'] / max(now - transfer['started'], 1e-3)
+            if transfer['total']:
+                eta = (transfer['total'] - transfer['done']) / rate \
+                      if rate else None
+                parts.append("%s %d%% %s/s ETA %s" % (
+                    transfer['name'], 100 * transfer['done'] /
+                    transfer['total'], format_size(rate), format_time(eta)))
+            else:
+                parts.append("%s %s %s/s" % (transfer['name'],
+                                             format_size(transfer['done']),
+                                             format_size(rate)))
+        done, rate, eta = self.rates(now)
+        total = "total %s, %s/s, ETA %s, %d done" % (
+            format_size(done), format_size(rate), format_time(eta),
+            self.finished)
+        if self.tty:
+            line = "  > %s" % " | ".join(parts + [total])
+            self.stream.write("\r%s%s" % (line, " " * (self._width -
+                                                       len(line))))
+            self.stream.flush()
+            self._width = len(line)
+        else:
+            self.logger.info("%s", "; ".join(parts + [total]))
+
+    def _clear(self):
+        """Removes the status line, needs the lock."""
+        if self.tty:
+            if self._width:
+                self.stream.write("\r%s\r" % (" " * self._width))
+                self.stream.flush()
+                self._width = 0
+            # Redraw right away; log lines keep their interval
+            self._lastdraw = 0
 
 def slugify(value):
     """
@@ -691,8 +2056,8 @@ def get_mapstr(mparser, link):
     if mparser.has_section('Map'):
         for key in ('chkdelete', 'friendlyname', 'name', 'date', 'count'):
             if mparser.has_option('Map', link[key]):
-                logger.debug("Map entry \"%s\" (%s) found for %s" % (link[key],
-                                            key, link['friendlyname']))
+                logger.debug("Map entry \"%s\" (%s) found for %s", link[key],
+                             key, link['friendlyname'])
                 return mparser.get('Map', link[key])
         return ""
     else:
@@ -705,119 +2070,1004 @@ def check_linkmatch(link, linklist):
     for key in ('chkdelete', 'friendlyname', 'name', 'date', 'count'):
         for arg in linklist:
             if fnmatch.fnmatch(link[key], arg):
-                logger.debug('"%s" matches "%s" as %s for %s' % (link[key],
-                                            arg, key, link['friendlyname']))
+                logger.debug('"%s" matches "%s" as %s for %s', link[key],
+                             arg, key, link['friendlyname'])
                 result = True
     return result
 
-def main():
-    """Main routine that contains the program logic."""
-    ### Parsing options
-    opts, args = optparse_setup()
-    global BASE_URL
-    BASE_URL = RAW_BASE_URL % ("s" if opts.allsecure else "")
+def parse_pqdate(date):
+    """Converts a PQ date string (as in link['date']) into a datetime.date.
+    The format depends on the GC.com account settings, so several formats
+    are tried. Returns datetime.date.min if the date can't be parsed, so the
+    result can always be used as a sort key.
+    """
+    for fmt in ('%m-%d-%Y', '%Y-%m-%d', '%d.%m.%Y', '%d-%b-%Y', '%d-%m-%Y',
+                '%m-%d-%y'):
+        try:
+            return datetime.datetime.strptime(date, fmt).date()
+        except (ValueError, TypeError):
+            pass
+    return datetime.date.min
 
-    if opts.netdebug:
-        import socks
-        import socket
-        socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, "127.0.0.1", 1080)
-        socket.socket = socks.socksocket
 
-    browser = PqBrowser()
-    excludes = []
-    for arg in args:
-        if arg[0] == '#':
-            excludes.append(arg[1:])
-            args.remove(arg)
+_WPT_START = '<wpt '
+_WPT_END = '</wpt>'
+_NAME_RE = re.compile(r'<name>\s*([^<]+?)\s*</name>')
 
-    delay = functools.partial(gdelay, odelay=opts.delay)
 
-    logger = logging.getLogger('main')
+class GpxReader(object):
+    """Streams the waypoints of a PQ GPX file without building a DOM.
 
-    if not opts.noupdate:
-        check_update(opts.nobrowser)
-    else:
-        logger.info("Update check skipped. Please check for updates yourself!")
+    The file is read in chunks; iterating over the reader yields a
+    (code, body) tuple for every <wpt> element, where code is the content of
+    its <name> tag (the GC code for caches) and body the raw XML of the
+    element. Everything before the first waypoint is available as header.
 
-    if not os.path.exists(opts.outputdir):
-        os.makedirs(opts.outputdir)
+    """
+    def __init__(self, path, chunksize=65536):
+        self.path = path
+        self.chunksize = chunksize
+        self._file = open(path, 'rb')
+        buf = ''
+        while True:
+            ind = buf.find(_WPT_START)
+            if ind != -1:
+                break
+            chunk = self._file.read(chunksize)
+            if not chunk:
+                # No waypoints at all
+                ind = buf.rfind('</gpx>')
+                if ind == -1:
+                    ind = len(buf)
+                break
+            buf += chunk
+        self.header = buf[:ind]
+        self._buffer = buf[ind:]
+
+    def __iter__(self):
+        buf = self._buffer
+        self._buffer = ''
+        while True:
+            end = buf.find(_WPT_END)
+            if end == -1:
+                chunk = self._file.read(self.chunksize)
+                if not chunk:
+                    break
+                buf += chunk
+                continue
+            end += len(_WPT_END)
+            start = buf.find(_WPT_START)
+            body = buf[start:end]
+            buf = buf[end:]
+            if start == -1 or start > end:
+                continue
+            match = _NAME_RE.search(body)
+            yield (match.group(1) if match else ''), body
+        self.close()
+
+    def close(self):
+        """Closes the underlying file."""
+        self._file.close()
+
+
+class GpxWriter(object):
+    """Writes a GPX file from a header (see GpxReader) and raw waypoints.
+    The file is replaced on close() only, see AtomicWriter."""
+    def __init__(self, path, header, sync=None):
+        self.path = path
+        self.count = 0
+        self._file = AtomicWriter(path, sync)
+        self._file.write(header.rstrip() + '\n')
+
+    def write(self, body):
+        """Appends a raw <wpt> element."""
+        self._file.write('  %s\n' % body)
+        self.count += 1
+
+    def close(self):
+        """Writes the footer and closes the file."""
+        self._file.write('</gpx>\n')
+        self._file.close()
+
+    def abort(self):
+        """Discards the file."""
+        self._file.abort()
+
+
+def merge_gpx(sources, output, wptoutput, sync=None):
+    """Merges several PQ GPX files into one, dropping duplicate waypoints.
+
+    sources -- list of (date, gpxfile, waypointfile) tuples, date is the PQ
+               date string and waypointfile may be None
+    output -- filename of the merged GPX file
+    wptoutput -- filename of the merged waypoints file
+    sync -- FileSync for the output files
+
+    The waypoints are spilled into a temporary SQLite database keyed by
+    their code, so the memory usage doesn't depend on the size or number of
+    PQs. The sources are inserted from the oldest to the newest PQ, so the
+    newest version of a cache replaces the older ones. The output is written
+    sorted by code. Returns the number of caches and waypoints written.
 
-    logger.debug("mechanize %d.%d.%d; BeautifulSoup: %s; Filename: %s; "
-                 "Python: %s" % (mechanize.__version__[0],
-                                 mechanize.__version__[1],
-                                 mechanize.__version__[2],
-                                 BeautifulSoup.__version__,
-                                 os.path.basename(sys.argv[0]),
-                                 sys.version))
-
-
-    ### Main program
-    logger = logging.getLogger('main.login')
-    if opts.pqsitefile:
-        logger.info("Skipping login, simulation mode")
-        browser.pqsimulate = True
-        browser.pqfile = opts.pqsitefile
-    else:
-        logger.info("Logging in as {username}".format(username=opts.username))
-        browser.login_gc(opts.username, opts.password,
-                         RAW_BASE_URL % ("s" if (opts.loginsecure or
-                                         opts.allsecure )
-                                         else ""))
-        delay()
-
-    logger = logging.getLogger('main.linkdb')
-    logger.info("Getting links")
-    linklist = browser.get_link_db(not opts.nospecial)
-    delay()
-    os.chdir(opts.outputdir)
-    if logger.getEffectiveLevel() <= 10:
-        for link in linklist:
-            logger.debug("Data for %s:" % link['friendlyname'])
-            for field, data in link.iteritems():
-                logger.debug('%s - %s: %s' % (link['friendlyname'], field,
-                                              data))
-
-    logger = logging.getLogger('main.linkdb.sync')
-
-    if opts.journal or opts.usejournal:
-        journal = True
-        cparser = ConfigParser.RawConfigParser()
-        cfiles = cparser.read([opts.journalfile])
-        logger.debug("Journal: %s" % cfiles)
-        if opts.resetjournal:
-            logger.info("Resetting journal...")
-            if cparser.has_section('Log'):
-                cparser.remove_section('Log')
-    else:
-        journal = False
+    """
+    logger = logging.getLogger('main.merge')
+    sources = sorted(sources, key=lambda source: parse_pqdate(source[0]))
+    fd, dbfile = tempfile.mkstemp(suffix='.pqmerge',
+                                  dir=os.path.dirname(os.path.abspath(output)))
+    os.close(fd)
+    headers = {}
+    try:
+        db = sqlite3.connect(dbfile)
+        db.execute("CREATE TABLE wpt (kind INTEGER, code TEXT, body BLOB, "
+                   "PRIMARY KEY (kind, code))")
+        for date, gpxfile, wptfile in sources:
+            for kind, path in enumerate((gpxfile, wptfile)):
+                if not path:
+                    continue
+                logger.debug("Merging %s (%s)", path, date)
+                reader = GpxReader(path)
+                headers[kind] = reader.header
+                db.executemany("INSERT OR REPLACE INTO wpt VALUES (?, ?, ?)",
+                               ((kind, code, sqlite3.Binary(body))
+                                for code, body in reader))
+            db.commit()
+
+        counts = []
+        for kind, path in enumerate((output, wptoutput)):
+            writer = GpxWriter(path, headers.get(kind, headers.get(0, '')),
+                               sync)
+            try:
+                for (body,) in db.execute("SELECT body FROM wpt WHERE kind=? "
+                                          "ORDER BY code", (kind,)):
+                    writer.write(str(body))
+            except:
+                writer.abort()
+                raise
+            writer.close()
+            counts.append(writer.count)
+        db.close()
+    finally:
+        remove(dbfile)
+    logger.info("Merged %d PQs into %s (%d caches, %d waypoints)",
+                len(sources), output, counts[0], counts[1])
+    return tuple(counts)
+
+
+_LAT_RE = re.compile(r'\slat="([-0-9.]+)"')
+_LON_RE = re.compile(r'\slon="([-0-9.]+)"')
+
+EARTH_RADIUS = 6371.0
+
+def wpt_position(body):
+    """Returns the (lat, lon) of a raw <wpt> element as floats."""
+    tag = body[:body.find('>')]
+    return (float(_LAT_RE.search(tag).group(1)),
+            float(_LON_RE.search(tag).group(1)))
+
+def haversine(lat, lon, lat0, lon0):
+    """Great circle distance in km between (lat0, lon0) and the points given
+    by the NumPy arrays lat and lon (decimal degrees)."""
+    import numpy
+    lat, lon = numpy.radians(lat), numpy.radians(lon)
+    lat0, lon0 = numpy.radians(lat0), numpy.radians(lon0)
+    a = (numpy.sin((lat - lat0) / 2) ** 2 + numpy.cos(lat) * numpy.cos(lat0)
+         * numpy.sin((lon - lon0) / 2) ** 2)
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
+
+
+class CacheIndex(object):
+    """A grid index over the caches of all downloaded PQs.
+
+    The index is an SQLite database that stores every cache with its
+    coordinates, the grid cell it belongs to and the raw <wpt> element, so
+    results can be written as GPX again. Only the newest version of a cache
+    (by PQ date) is kept. Queries select the candidate cells through the
+    database index and do the exact bounding box or distance test on NumPy
+    arrays.
+
+    """
+    def __init__(self, path, cellsize=0.1):
+        self.logger = logging.getLogger('index')
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY "
+                        "KEY, value BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS caches (code TEXT PRIMARY "
+                        "KEY, lat REAL, lon REAL, cellx INTEGER, celly "
+                        "INTEGER, pqdate INTEGER, body BLOB)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cells ON caches "
+                        "(celly, cellx)")
+        # The cell size of an existing index can't be changed
+        row = self.db.execute("SELECT value FROM meta WHERE key='cellsize'"
+                              ).fetchone()
+        if row:
+            cellsize = float(row[0])
+        else:
+            self.db.execute("INSERT INTO meta VALUES ('cellsize', ?)",
+                            (str(cellsize),))
+            self.db.commit()
+        self.cellsize = cellsize
+
+    def _cell(self, value):
+        """Grid cell number of a coordinate."""
+        return int(value // self.cellsize)
+
+    def update(self, gpxfile, date):
+        """Adds or updates the caches of a PQ GPX file. Caches that are
+        already indexed from a newer PQ are left alone. Returns the number of
+        caches read."""
+        pqdate = parse_pqdate(date).toordinal()
+        reader = GpxReader(gpxfile)
+        rows = []
+        count = 0
+        for code, body in reader:
+            count += 1
+            lat, lon = wpt_position(body)
+            rows.append((code, lat, lon, self._cell(lon), self._cell(lat),
+                         pqdate, sqlite3.Binary(body)))
+            if len(rows) >= 1000:
+                self._insert(rows)
+                rows = []
+        self._insert(rows)
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('header', ?)",
+                        (sqlite3.Binary(reader.header),))
+        self.db.commit()
+        self.logger.debug("Indexed %d caches of %s", count, gpxfile)
+        return count
+
+    def _insert(self, rows):
+        """Inserts new caches and replaces older versions of known ones."""
+        self.db.executemany("INSERT OR IGNORE INTO caches VALUES "
+                            "(?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.executemany("UPDATE caches SET lat=?, lon=?, cellx=?, "
+                            "celly=?, pqdate=?, body=? WHERE code=? AND "
+                            "pqdate<=?", [row[1:] + row[:1] + row[5:6]
+                                          for row in rows])
+
+    def _candidates(self, minlat, minlon, maxlat, maxlon):
+        """Returns the rowids and coordinates of all caches in the grid cells
+        that touch the given bounding box as NumPy arrays."""
+        import numpy
+        rows = self.db.execute(
+            "SELECT rowid, lat, lon FROM caches WHERE celly BETWEEN ? AND ? "
+            "AND cellx BETWEEN ? AND ?", (self._cell(minlat),
+                                          self._cell(maxlat),
+                                          self._cell(minlon),
+                                          self._cell(maxlon))).fetchall()
+        data = numpy.array(rows, dtype=float).reshape(-1, 3)
+        return data[:, 0].astype(numpy.int64), data[:, 1], data[:, 2]
+
+    def bbox(self, minlat, minlon, maxlat, maxlon):
+        """Returns the rowids of all caches in a bounding box."""
+        rowids, lat, lon = self._candidates(minlat, minlon, maxlat, maxlon)
+        mask = ((lat >= minlat) & (lat <= maxlat) &
+                (lon >= minlon) & (lon <= maxlon))
+        return rowids[mask]
+
+    def radius(self, lat0, lon0, radius):
+        """Returns the rowids of all caches within radius km of a point, the
+        nearest first."""
+        import numpy
+        dlat = numpy.degrees(radius / EARTH_RADIUS)
+        dlon = dlat / max(numpy.cos(numpy.radians(lat0)), 1e-6)
+        rowids, lat, lon = self._candidates(lat0 - dlat, lon0 - dlon,
+                                            lat0 + dlat, lon0 + dlon)
+        distance = haversine(lat, lon, lat0, lon0)
+        mask = distance <= radius
+        return rowids[mask][numpy.argsort(distance[mask], kind='mergesort')]
+
+    def export(self, rowids, path):
+        """Writes the given caches into a GPX file, returns the count."""
+        row = self.db.execute("SELECT value FROM meta WHERE key='header'"
+                              ).fetchone()
+        writer = GpxWriter(path, str(row[0]) if row else
+                           '<?xml version="1.0" encoding="utf-8"?>\n<gpx>')
+        try:
+            rowids = [int(rowid) for rowid in rowids]
+            for start in range(0, len(rowids), 500):
+                chunk = rowids[start:start + 500]
+                bodies = dict(self.db.execute(
+                    "SELECT rowid, body FROM caches WHERE rowid IN (%s)"
+                    % ",".join("?" * len(chunk)), chunk))
+                for rowid in chunk:
+                    writer.write(str(bodies[rowid]))
+        except:
+            writer.abort()
+            raise
+        writer.close()
+        return writer.count
+
+    def close(self):
+        """Closes the database."""
+        self.db.close()
+
+
+_DIFFICULTY_RE = re.compile(r'<groundspeak:difficulty>\s*([0-9.]+)')
+_TERRAIN_RE = re.compile(r'<groundspeak:terrain>\s*([0-9.]+)')
+_TYPE_RE = re.compile(r'<groundspeak:type>\s*([^<]*?)\s*<')
+
+def load_cache_table(gpxfile):
+    """Reads a PQ GPX file into a table of NumPy arrays.
+
+    Returns the GPX header, the list of (code, body) tuples and a dictionary
+    with the arrays lat, lon, difficulty, terrain and type (an index into
+    the list under the key 'types').
+
+    """
+    import numpy
+    reader = GpxReader(gpxfile)
+    caches = []
+    lat, lon, difficulty, terrain, types = [], [], [], [], []
+    typecodes = {}
+    for code, body in reader:
+        caches.append((code, body))
+        position = wpt_position(body)
+        lat.append(position[0])
+        lon.append(position[1])
+        for regex, column in ((_DIFFICULTY_RE, difficulty),
+                              (_TERRAIN_RE, terrain)):
+            match = regex.search(body)
+            column.append(float(match.group(1)) if match else 0.0)
+        match = _TYPE_RE.search(body)
+        types.append(typecodes.setdefault(match.group(1) if match else '',
+                                          len(typecodes)))
+    typenames = sorted(typecodes, key=typecodes.get)
+    table = {
+        'lat': numpy.array(lat, dtype=float),
+        'lon': numpy.array(lon, dtype=float),
+        'difficulty': numpy.array(difficulty, dtype=float),
+        'terrain': numpy.array(terrain, dtype=float),
+        'type': numpy.array(types, dtype=numpy.int32),
+        'types': typenames,
+        }
+    return reader.header, caches, table
+
+_GS_NAME_RE = re.compile(r'<groundspeak:name>\s*([^<]*?)\s*'
+                         r'</groundspeak:name>')
+_CONTAINER_RE = re.compile(r'<groundspeak:container>\s*([^<]*?)\s*<')
+
+GGZ_INDEX = 'index/com/garmin/geocaches/v0/index.xml'
+GGZ_SIZES = {'micro': 2, 'small': 3, 'regular': 4, 'large': 5}
+
+
+class GgzWriter(object):
+    """Writes PQ GPX files into a GGZ archive, the indexed GPX format of
+    Garmin devices.
+
+    A GGZ file is a ZIP archive with the caches split into GPX files of at
+    most chunksize bytes under data/ and an index (GGZ_INDEX) that lists
+    every cache with its position, ratings and byte range in its GPX file,
+    so the device doesn't have to parse all files. The sources are streamed
+    with GpxReader; only the current chunk is kept in memory. Caches that
+    were already added are skipped, so the newest PQ should be added first.
+    The archive is written with AtomicWriter.
+
+    """
+    def __init__(self, path, chunksize=4 * 1024 ** 2, sync=None):
+        self.path = path
+        self.chunksize = chunksize
+        self.count = 0
+        self._codes = set()
+        self._file = AtomicWriter(path, sync)
+        self._zip = zipfile.ZipFile(self._file, 'w', zipfile.ZIP_DEFLATED)
+        self._index = []
+        self._chunk = None
+
+    def add(self, gpxfile):
+        """Adds the caches of a GPX file, returns the number added."""
+        reader = GpxReader(gpxfile)
+        header = reader.header.rstrip() + '\n'
+        base = os.path.splitext(os.path.basename(gpxfile))[0]
+        added, part = 0, 0
+        for code, body in reader:
+            if code in self._codes:
+                continue
+            if self._chunk is None or self._chunk[1].tell() > self.chunksize:
+                self._flush()
+                part += 1
+                self._chunk = ('%s_%d.gpx' % (base, part),
+                               StringIO.StringIO(), [])
+                self._chunk[1].write(header)
+            name, data, entries = self._chunk
+            data.write('  ')
+            entries.append(self._entry(code, body, data.tell()))
+            data.write(body + '\n')
+            self._codes.add(code)
+            added += 1
+        self._flush()
+        self.count += added
+        return added
+
+    def _entry(self, code, body, pos):
+        """Returns the index XML of a cache at pos of its chunk."""
+        lat, lon = wpt_position(body)
+        values = {}
+        for key, regex in (('name', _GS_NAME_RE), ('type', _TYPE_RE),
+                           ('difficulty', _DIFFICULTY_RE),
+                           ('terrain', _TERRAIN_RE),
+                           ('container', _CONTAINER_RE)):
+            match = regex.search(body)
+            values[key] = match.group(1) if match else ''
+        return ('    <gch>\n'
+                '      <code>%s</code>\n'
+                '      <name>%s</name>\n'
+                '      <type>%s</type>\n'
+                '      <lat>%s</lat>\n'
+                '      <lon>%s</lon>\n'
+                '      <file_pos>%d</file_pos>\n'
+                '      <file_len>%d</file_len>\n'
+                '      <ratings>\n'
+                '        <difficulty>%s</difficulty>\n'
+                '        <size>%d</size>\n'
+                '        <terrain>%s</terrain>\n'
+                '      </ratings>\n'
+                '      <found>%s</found>\n'
+                '    </gch>\n' % (
+                    code, values['name'], values['type'], lat, lon, pos,
+                    len(body), values['difficulty'] or '0',
+                    GGZ_SIZES.get(values['container'].lower(), 1),
+                    values['terrain'] or '0',
+                    'true' if '<sym>Geocache Found</sym>' in body
+                    else 'false'))
+
+    def _flush(self):
+        """Writes the current chunk into the archive."""
+        if self._chunk is None:
+            return
+        name, data, entries = self._chunk
+        self._chunk = None
+        data.write('</gpx>\n')
+        data = data.getvalue()
+        self._zip.writestr('data/%s' % name, data)
+        self._index.append('  <file>\n'
+                           '    <name>%s</name>\n'
+                           '    <crc>%08x</crc>\n'
+                           '    <time>%s</time>\n' % (
+                               name, zlib.crc32(data) & 0xffffffff,
+                               datetime.datetime.utcnow().strftime(
+                                   '%Y-%m-%dT%H:%M:%SZ')))
+        self._index.extend(entries)
+        self._index.append('  </file>\n')
+
+    def close(self):
+        """Writes the index and replaces path with the new archive."""
+        self._flush()
+        self._zip.writestr(GGZ_INDEX,
+                           '<?xml version="1.0" encoding="UTF-8"?>\n'
+                           '<ggz xmlns="http://www.opencaching.com/xmlschemas'
+                           '/ggz/1/0">\n%s</ggz>\n' % ''.join(self._index))
+        self._zip.close()
+        self._file.close()
+
+    def abort(self):
+        """Discards the archive."""
+        self._file.abort()
+
+
+def write_ggz(gpxfiles, output, sync=None):
+    """Writes the given GPX files (newest PQ first) into the GGZ archive
+    output. Returns the number of caches written."""
+    logger = logging.getLogger('main.ggz')
+    writer = GgzWriter(output, sync=sync)
+    try:
+        for gpxfile in gpxfiles:
+            logger.debug("Adding %s to %s", gpxfile, output)
+            writer.add(gpxfile)
+    except:
+        writer.abort()
+        raise
+    writer.close()
+    logger.info("Wrote %s (%d caches)", output, writer.count)
+    return writer.count
+
+
+def parse_range(value):
+    """Parses a range like "1.5-3" (or a single value) into a tuple."""
+    values = [float(x) for x in value.split('-', 1)]
+    return values[0], values[-1]
+
+
+class CacheFilter(object):
+    """Removes caches from unzipped PQs that don't match the [Filter]
+    section of pqdl.ini. Supported settings:
+
+    home -- LAT,LON of the center for radius
+    radius -- maximum distance from home in km
+    difficulty -- range of difficulty ratings, like 1-3
+    terrain -- range of terrain ratings, like 1-4.5
+    exclude -- comma separated list of cache types, like Earthcache
+
+    All conditions are evaluated as NumPy masks over the whole PQ. The
+    trimmed files are written with the given FileSync. Invalid settings
+    raise a ValueError.
+
+    """
+    def __init__(self, settings, sync=None):
+        self.logger = logging.getLogger('main.filter')
+        self.sync = sync
+        self.home = None
+        self.radius = None
+        if ('home' in settings) != ('radius' in settings):
+            raise ValueError("home and radius must be used together")
+        if 'radius' in settings:
+            try:
+                self.home = [float(x) for x in settings['home'].split(',')]
+                self.radius = float(settings['radius'])
+            except ValueError:
+                raise ValueError("home must be LAT,LON and radius a number "
+                                 "of km")
+            if len(self.home) != 2:
+                raise ValueError("home must be LAT,LON")
+        for key in ('difficulty', 'terrain'):
+            try:
+                setattr(self, key, parse_range(settings[key])
+                        if key in settings else None)
+            except ValueError:
+                raise ValueError("%s must be a rating or a range like 1-3"
+                                 % key)
+        self.exclude = set(name.strip().lower() for name in
+                           settings.get('exclude', '').split(',')
+                           if name.strip())
+
+    def mask(self, table):
+        """Returns a boolean array, True for caches that are kept."""
+        import numpy
+        mask = numpy.ones(len(table['lat']), dtype=bool)
+        if self.radius is not None:
+            mask &= haversine(table['lat'], table['lon'],
+                              self.home[0], self.home[1]) <= self.radius
+        for key in ('difficulty', 'terrain'):
+            limits = getattr(self, key)
+            if limits is not None:
+                mask &= ((table[key] >= limits[0]) &
+                         (table[key] <= limits[1]))
+        if self.exclude:
+            excluded = [code for code, name in enumerate(table['types'])
+                        if name.lower() in self.exclude]
+            mask &= ~numpy.in1d(table['type'], excluded)
+        return mask
+
+    def apply(self, gpxfile, wptfile=None):
+        """Trims a GPX file (and the waypoints file that belongs to it)
+        in place. Returns the number of caches kept and read."""
+        header, caches, table = load_cache_table(gpxfile)
+        mask = self.mask(table)
+        kept = [cache for cache, keep in zip(caches, mask) if keep]
+        self._write(gpxfile, header, kept)
+        if wptfile:
+            # Additional waypoints share the code suffix with their cache
+            # (GC12345 -> PK12345)
+            suffixes = set(code[2:] for code, body in kept)
+            reader = GpxReader(wptfile)
+            self._write(wptfile, reader.header,
+                        [(code, body) for code, body in reader
+                         if code[2:] in suffixes])
+        self.logger.info("%s: %d of %d caches kept", gpxfile, len(kept),
+                         len(caches))
+        return len(kept), len(caches)
+
+    def _write(self, path, header, caches):
+        """Replaces a file with the trimmed version."""
+        writer = GpxWriter(path, header, self.sync)
+        try:
+            for code, body in caches:
+                writer.write(body)
+        except:
+            writer.abort()
+            raise
+        writer.close()
+
+
+def query_index(opts):
+    """Runs a --near or --bbox query on the cache index."""
+    logger = logging.getLogger('index.query')
+    outpath = functools.partial(os.path.join, opts.outputdir)
+    if not os.path.isfile(outpath(opts.indexfile)):
+        logger.critical("There is no cache index %s, create it with --index "
+                        "first (and check -o).", outpath(opts.indexfile))
+        sys.exit(1)
+    index = CacheIndex(outpath(opts.indexfile))
+    try:
+        if opts.near:
+            lat, lon, radius = [float(x) for x in opts.near.split(',')]
+            logger.info("Searching caches within %s km of %s, %s",
+                        radius, lat, lon)
+            rowids = index.radius(lat, lon, radius)
+        else:
+            minlat, minlon, maxlat, maxlon = [float(x) for x in
+                                              opts.bbox.split(',')]
+            logger.info("Searching caches between %s, %s and %s, %s",
+                        minlat, minlon, maxlat, maxlon)
+            rowids = index.bbox(minlat, minlon, maxlat, maxlon)
+        count = index.export(rowids, outpath(opts.queryout))
+    finally:
+        index.close()
+    logger.info("%d caches written to %s", count, outpath(opts.queryout))
+
+class Scheduler(object):
+    """Decides in which order the selected PQs are downloaded and whether a
+    PQ can still be downloaded before the deadline.
+
+    policy -- listing, smallest, newest or priority
+    deadline -- time.time() value by which all downloads should be done, or
+                None
+    priorities -- dictionary of PQ (name, friendlyname, ID, ...) to number,
+                  keys in lower case (as read by ConfigParser)
 
-    if opts.mappings:
-        mparser = ConfigParser.RawConfigParser()
-        mfiles = mparser.read([opts.mapfile])
-        logger.debug("Mappings: %s" %mfiles)
+    """
+    def __init__(self, policy='listing', deadline=None, priorities=None):
+        self.policy = policy
+        self.deadline = deadline
+        self.priorities = priorities or {}
+
+    def priority(self, link):
+        """Returns the priority of a PQ, 0 if none is set."""
+        for key in ('chkdelete', 'friendlyname', 'name', 'date', 'count'):
+            value = self.priorities.get(link[key].lower())
+            if value is not None:
+                return float(value)
+        return 0
+
+    def order(self, dllist):
+        """Returns the PQs in download order. The sort is stable, so PQs
+        that compare equal keep the listing order."""
+        if self.policy == 'smallest':
+            return sorted(dllist, key=lambda link:
+                          parse_size(link['size']) or 0)
+        elif self.policy == 'newest':
+            return sorted(dllist, key=lambda link: parse_pqdate(link['date']),
+                          reverse=True)
+        elif self.policy == 'priority':
+            return sorted(dllist, key=lambda link: -self.priority(link))
+        return list(dllist)
+
+    def fits(self, link, rate):
+        """Checks if a PQ can be downloaded before the deadline.
+
+        rate -- bytes per second of a single download so far, or None if
+                unknown (then only the deadline itself is checked)
+
+        """
+        if self.deadline is None:
+            return True
+        now = time.time()
+        size = parse_size(link['size'])
+        if rate and size:
+            return now + size / rate <= self.deadline
+        return now < self.deadline
+
+
+class FilenameDict(object):
+    """A special dictionary for filename templates whose values depend on
+    the parameters given to the constructor (link and suffix).
+
+    """
+    def __init__(self, link, suffix, singlefile=False):
+        """Inits the FilenameDict.
+
+        link -- dictionary with link template values
+        suffix -- the filename suffix, as example 'zip' or 'gpx'
+        singlefile -- use the names without date (-s)
+
+        """
+        self.suffix = suffix
+        self.link = link
+        self.base = self.single if singlefile else self.basic
+
+    basic = {
+            'normal':'{mapstr}{chkdelete}_{friendlyname}_{date}',
+            'myfinds':'{mapstr}MyFinds_{date}',
+            'waypoints':('{mapstr}{chkdelete}_'
+                         '{friendlyname}_{date}_waypoints')
+            }
+
+    single = {
+            'normal':'{mapstr}{chkdelete}_{friendlyname}',
+            'myfinds':'{mapstr}MyFinds',
+            'waypoints':'{mapstr}{chkdelete}_{friendlyname}_waypoints'
+            }
+
+    def __getattr__(self, name):
+        return "%s.%s" % (self.base[name].format(**self.link), self.suffix)
+
+
+class HookPipeline(object):
+    """Runs the post-processing hooks ([Hook NAME] sections, see
+    read_sections()) for every PQ in a pool of worker threads.
+
+    submit() blocks while queuesize PQs are waiting, so the downloads don't
+    run away from the hooks. Every hook run is logged with its exit status
+    (0 for callables that return None, -1 for errors) and duration, counted
+    in the metrics and sent as a hook_finished event. close() waits until
+    all submitted PQs are done.
 
-    if opts.myfinds:
-        browser.trigger_myfinds()
+    """
+    def __init__(self, hooks, workers=2, queuesize=4, metrics=None,
+                 events=None, account=None):
+        self.logger = logging.getLogger('main.hook')
+        self.hooks = hooks
+        self.metrics = metrics or Metrics()
+        self.events = events or EventStream()
+        self.account = account
+        self.queue = Queue.Queue(max(queuesize, 1))
+        self.threads = []
+        for number in range(max(workers, 1)):
+            thread = threading.Thread(target=self._worker,
+                                      name=threading.current_thread().name)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, link):
+        """Queues a PQ for its hooks."""
+        self.queue.put(link)
+
+    def close(self):
+        """Waits for the queued PQs and stops the workers."""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _worker(self):
+        """Runs the hooks of queued PQs until close()."""
+        while True:
+            link = self.queue.get()
+            if link is None:
+                break
+            for name, settings in self.hooks:
+                started = time.time()
+                try:
+                    status = self.run(name, settings, link)
+                except:
+                    # Even sys.exit() in a callable must not end the worker,
+                    # submit() and close() would wait for it forever
+                    self.logger.exception('Hook %s for "%s" failed', name,
+                                          link['name'])
+                    status = -1
+                duration = time.time() - started
+                log = self.logger.info if status == 0 else self.logger.error
+                log('Hook %s for "%s" finished with status %d in %s', name,
+                    link['name'], status, format_time(duration))
+                self.metrics.add('hooks')
+                self.metrics.add('hook seconds', duration)
+                if status != 0:
+                    self.metrics.add('failed hooks')
+                self.events.emit('hook_finished', link, account=self.account,
+                                 hook=name, status=status, seconds=duration)
+
+    @staticmethod
+    def check(settings):
+        """Raises ValueError if the settings of a hook can't be run."""
+        if 'callable' in settings:
+            if ':' not in settings['callable']:
+                raise ValueError("callable has to be module:function, not %r"
+                                 % settings['callable'])
+        elif not settings.get('command', '').strip():
+            raise ValueError("a command or a callable is needed")
+        try:
+            if float(settings.get('timeout', 0)) < 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError("timeout has to be a number of seconds, not %r"
+                             % settings['timeout'])
+
+    def run(self, name, settings, link):
+        """Runs one hook for a PQ, returns the exit status."""
+        try:
+            if 'callable' in settings:
+                module, function = settings['callable'].split(':', 1)
+                function = getattr(importlib.import_module(module.strip()),
+                                   function.strip())
+                return int(function(link) or 0)
+            args = [arg.format(**link) for arg in
+                    shlex.split(settings['command'],
+                                posix=(os.name != 'nt'))]
+        except Exception:
+            self.logger.exception('Hook %s for "%s" failed', name,
+                                  link['name'])
+            return -1
+        self.logger.debug("Hook %s: %s", name, args)
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        except OSError, error:
+            self.logger.error("Hook %s can't be started: %s", name, error)
+            return -1
+        timeout = float(settings.get('timeout', 0))
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self._kill, (name, process))
+            timer.start()
+        try:
+            output = process.communicate()[0]
+        finally:
+            if timer:
+                timer.cancel()
+        if output:
+            self.logger.debug("Hook %s output:\n%s", name, output.rstrip())
+        return process.returncode
+
+    def _kill(self, name, process):
+        """Stops a hook that ran into its timeout."""
+        self.logger.error("Hook %s timed out", name)
+        try:
+            process.kill()
+        except OSError:
+            # Already done
+            pass
 
-    logger = logging.getLogger('main.select')
-    logger.info("Selecting files")
 
-    if (logger.getEffectiveLevel() > 10) and len(args):
-        logger.info("NOTE: please enable debug (-d) if you want to see what "
-                    "includes/excludes do or if they don't work as expected!")
+class PqSession(object):
+    """A PqDL session for one GC.com account, to use PqDL as a library.
+
+    The session wraps a PqBrowser and does the same steps as the command
+    line, but never changes the working directory or exits the process.
+    Errors are raised as exceptions (LoginError if the login fails).
+    Options are passed as keyword arguments with the names of the command
+    line options, for example:
+
+        session = PqSession('user', 'secret', '/data/pqs', unzip=True,
+                            journal=True)
+        session.login()
+        for link in session.run(['Home*']):
+            print link['gpxfile']
+
+    download() and process() are generators, so every PQ is available as
+    soon as it's done. A session can be used for any number of runs.
+
+    """
+    def __init__(self, username=None, password=None, outputdir=None,
+                 opts=None, limits=None, metrics=None, progress=None,
+                 eventstream=None, **options):
+        """Inits the session.
+
+        opts -- options as returned by default_options(), defaults are used
+                if not given
+        limits, metrics, progress, eventstream -- Limits, Metrics, Progress
+                                                  and EventStream instances
+                                                  that may be shared with
+                                                  other sessions
+
+        Without limits, they are built from the options like on the command
+        line. Without an eventstream, the session writes the events to the
+        events option itself (until close() is called).
+
+        """
+        self.opts = copy.copy(opts) if opts else default_options()
+        for key, value in options.iteritems():
+            setattr(self.opts, key, value)
+        if username is not None:
+            self.opts.username = username
+        if password is not None:
+            self.opts.password = password
+        if outputdir is not None:
+            self.opts.outputdir = outputdir
+        self.metrics = metrics or Metrics()
+        self.progress = progress or Progress()
+        self._ownevents = eventstream is None
+        self.events = eventstream or EventStream(self.opts.events)
+        self.limits = limits or Limits(int(self.opts.connections),
+                                       float(self.opts.ratelimit),
+                                       Bandwidth.from_options(self.opts),
+                                       CircuitBreaker())
+        self.sync = FileSync(self.opts.fsync)
+        self.browser = PqBrowser()
+        self.browser.sync = self.sync
+        self.browser.limits = self.limits
+        self.browser.metrics = self.metrics
+        self.browser.retry = RetryPolicy(int(self.opts.retries),
+                                         float(self.opts.backoff),
+                                         float(self.opts.timeout),
+                                         self.limits.breaker)
+        self.delay = functools.partial(gdelay, odelay=self.opts.delay)
+        self.outpath = functools.partial(os.path.join, self.opts.outputdir)
+        self.journal = None
+        self.mparser = None
+        self.state = None
+        self.hooks = None
+        self._lock = threading.Lock()
+        self._dlbytes = 0
+        self._dltime = 0.0
+        if not os.path.exists(self.opts.outputdir):
+            os.makedirs(self.opts.outputdir)
+        # Temporary files of AtomicWriter that a crash left behind
+        for name in fnmatch.filter(os.listdir(self.opts.outputdir),
+                                   '*' + AtomicWriter.SUFFIX):
+            remove(self.outpath(name))
+
+    def login(self):
+        """Logs in, or enables the simulation mode if pqsitefile is set."""
+        opts = self.opts
+        logger = logging.getLogger('main.login')
+        if opts.pqsitefile:
+            logger.info("Skipping login, simulation mode")
+            self.browser.pqsimulate = True
+            self.browser.pqfile = opts.pqsitefile
+        else:
+            logger.info("Logging in as {username}".format(
+                username=opts.username))
+            self.browser.login_gc(opts.username, opts.password,
+                                  RAW_BASE_URL % ("s" if (opts.loginsecure or
+                                                  opts.allsecure)
+                                                  else ""))
+            self.metrics.add('logins')
+            self.delay()
+
+    def list_pqs(self):
+        """Returns the list of the PQs available for download."""
+        logger = logging.getLogger('main.linkdb')
+        logger.info("Getting links")
+        snapshot = (ListingSnapshot(self.outpath(self.opts.listingfile))
+                    if self.opts.listingfile else None)
+        previous = snapshot.dates() if snapshot else {}
+        linklist = self.browser.get_link_db(not self.opts.nospecial,
+                                            snapshot)
+        self.metrics.add('listed', len(linklist))
+        for link in linklist:
+            self.event('listed', link)
+            date = previous.pop(link['chkdelete'], None)
+            if snapshot and date is None:
+                logger.debug('"%s" is new', link['name'])
+            elif date is not None and date != link['date']:
+                logger.debug('"%s" changed since the last run (%s)',
+                             link['name'], date)
+                self.event('changed', link, previous=date)
+        for chkdelete in previous:
+            logger.debug("PQ %s is gone since the last run", chkdelete)
+        if snapshot:
+            snapshot.save()
+        self.delay()
+        if logger.isEnabledFor(logging.DEBUG):
+            for link in linklist:
+                logger.debug("Data for %s:", link['friendlyname'])
+                for field, data in link.iteritems():
+                    logger.debug('%s - %s: %s', link['friendlyname'], field,
+                                 data, extra={'pq': link['chkdelete'],
+                                              'field': field})
+        return linklist
+
+    def load_journal(self):
+        """Reads the journal and mapping files if they are enabled."""
+        opts = self.opts
+        logger = logging.getLogger('main.linkdb.sync')
+        if opts.journal or opts.usejournal:
+            self.journal = ConfigParser.RawConfigParser()
+            cfiles = self.journal.read([self.outpath(opts.journalfile)])
+            logger.debug("Journal: %s", cfiles)
+            if opts.resetjournal:
+                logger.info("Resetting journal...")
+                if self.journal.has_section('Log'):
+                    self.journal.remove_section('Log')
+        if opts.mappings:
+            self.mparser = ConfigParser.RawConfigParser()
+            mfiles = self.mparser.read([self.outpath(opts.mapfile)])
+            logger.debug("Mappings: %s", mfiles)
+
+    def select(self, linklist, args=(), excludes=()):
+        """Returns the PQs of linklist that should be downloaded: those that
+        match args (all if empty), don't match excludes and are not in the
+        journal with the same date."""
+        args, excludes = list(args), list(excludes)
+        logger = logging.getLogger('main.select')
+        logger.info("Selecting files")
+
+        if (logger.getEffectiveLevel() > 10) and len(args):
+            logger.info("NOTE: please enable debug (-d) if you want to see "
+                        "what includes/excludes do or if they don't work as "
+                        "expected!")
 
-    if linklist == []:
-        logger.info("No valid Pocket Queries found online.")
         dllist = []
-    else:
+        if linklist == []:
+            logger.info("No valid Pocket Queries found online.")
+            return dllist
         if not len(args):
             logger.debug("No include arguments given, downloading all PQs.")
-        dllist = []
         for link in linklist:
-            assert isinstance(args, list)
-            if journal:
+            if self.journal is not None:
                 try:
-                    if cparser.get('Log', link['chkdelete']) == link['date']:
+                    if (self.journal.get('Log', link['chkdelete']) ==
+                        link['date']):
                         logger.info('"{name}" skipped because {friendlyname} '
                                     'with date {date} has already been '
                                     'downloaded.'.format(**link))
@@ -834,128 +3084,395 @@ def main():
                             format(**link))
                 dllist.append(link)
             else:
-                logger.debug('"{name}" skipped because it is not in the '
-                'arguments list.'.format(**link))
+                logger.debug('"%s" skipped because it is not in the '
+                             'arguments list.', link['name'])
         if dllist == []:
             logger.info("All PQs skipped." if logger.getEffectiveLevel() <= 10
                         else "All PQs skipped. If you want to know why, "
                         "enable debug (-d)!")
+        return dllist
 
-    logger = logging.getLogger('main.download')
-    logger.info("Downloading selected files")
+    def download(self, dllist, started=None):
+        """Downloads the given PQs, yields every PQ when it's done.
+        link['filename'] is the downloaded file. The --deadline counts from
+        started (a time.time() value, now by default).
 
-    def _reporthook(count, blocksize, totalsize):
-        """Local hook for mechanize.retrieve()"""
-        percent = int(count*blocksize*100/totalsize)
-        sys.stdout.write("\r  > %s%%" % (str(percent)))
-        sys.stdout.flush()
+        The PQs are ordered by the --schedule policy and downloaded by
+        --parallel worker threads, each with its own clone of the browser.
+        PQs that won't finish before the --deadline are skipped and left
+        for the next run. PQs that failed even after the retries of the
+        browser are tried once more after all others; if that fails too,
+        they are left out (and not written to the journal).
 
-    if opts.list:
-        logger.info("Downloads skipped!")
-        dllist = []
-    for number, link in enumerate(dllist):
+        """
+        opts = self.opts
+        logger = logging.getLogger('main.download')
+        started = started or time.time()
+        scheduler = Scheduler(opts.schedule, (started + float(opts.deadline)
+                                              if float(opts.deadline)
+                                              else None), opts.priority)
+        dllist = scheduler.order(dllist)
+        failed = []
+        for link in self._download_batch(scheduler, list(enumerate(dllist)),
+                                         len(dllist), failed):
+            yield link
+        if failed:
+            logger.info("Trying %d failed PQs again", len(failed))
+            retry = [(number, link) for number, link, error in failed]
+            failed = []
+            for link in self._download_batch(scheduler, retry, len(dllist),
+                                             failed):
+                yield link
+        for number, link, error in failed:
+            logger.error('"{name}" could not be downloaded: {0}'.format(
+                error, **link))
+            self.metrics.add('failed')
+
+    def _download_batch(self, scheduler, batch, count, failed):
+        """Downloads the (number, link) pairs of batch in parallel, yields
+        every PQ when it's done. Failed PQs are appended to failed as
+        (number, link, error)."""
+        opts = self.opts
+        logger = logging.getLogger('main.download')
+        pending = Queue.Queue()
+        for number, link in batch:
+            pending.put((number, link))
+        # Bounded, so the workers wait while the PQs aren't processed (for
+        # example because the hooks are behind)
+        parallel = min(max(int(opts.parallel), 1), len(batch))
+        results = Queue.Queue(max(parallel, 1))
+        stop = threading.Event()
+
+        def report(result):
+            """Passes a result to the generator unless it's stopped."""
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=0.5)
+                    return
+                except Queue.Full:
+                    pass
+
+        def worker(browser):
+            """Downloads PQs until none are left."""
+            while not stop.is_set():
+                try:
+                    number, link = pending.get_nowait()
+                except Queue.Empty:
+                    break
+                if not scheduler.fits(link, self._rate()):
+                    report(('deferred', link, None))
+                    continue
+                try:
+                    self._download_one(browser, number, count, link)
+                    report(('done', link, None))
+                except (mechanize.URLError, httplib.HTTPException,
+                        socket.error, PqDLError), error:
+                    report(('failed', link, (number, error)))
+                except Exception:
+                    report(('error', link, sys.exc_info()))
+            report(None)
+
+        workers = []
+        for number in range(parallel):
+            workers.append(threading.Thread(
+                target=worker, name=threading.current_thread().name,
+                args=(self.browser if not number else self.browser.clone(),)))
+            workers[-1].daemon = True
+            workers[-1].start()
+
+        running = len(workers)
+        try:
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                state, link, exc_info = result
+                if state == 'deferred':
+                    logger.info('"{name}" ({size}) deferred to the next run, '
+                                'it would not finish before the deadline.'.
+                                format(**link))
+                    self.metrics.add('deferred')
+                    continue
+                if state == 'failed':
+                    logger.warning('"{name}" failed: {0}'.format(exc_info[1],
+                                                                 **link))
+                    failed.append((exc_info[0], link, exc_info[1]))
+                    continue
+                if state == 'error':
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                self.mark_journal(link)
+                self.checkpoint(link, 'downloaded')
+                yield link
+        finally:
+            stop.set()
+
+    def event(self, event, link=None, **fields):
+        """Emits an event of this account to the event stream."""
+        self.events.emit(event, link, account=self.opts.username, **fields)
+
+    def mark_journal(self, link):
+        """Records a downloaded PQ in the journal (written by finish())."""
+        if self.journal is not None and self.opts.journal:
+            if not self.journal.has_section('Log'):
+                self.journal.add_section('Log')
+            self.journal.set('Log', link['chkdelete'], link['date'])
+
+    def _rate(self):
+        """Average speed of a single download so far in bytes per second, or
+        None if nothing has been downloaded yet."""
+        with self._lock:
+            if not self._dltime:
+                return None
+            return self._dlbytes / self._dltime
+
+    def _download_one(self, browser, number, count, link):
+        """Downloads one PQ with the given browser."""
+        logger = logging.getLogger('main.download')
         if link['name'] != link['friendlyname']:
             logger.info('Downloading {0}/{1}: "{name}" (Friendly Name: '
                         '{friendlyname}) ({size}) [{date}]'.
-                        format(number+1, len(dllist), **link))
+                        format(number+1, count, **link))
         else:
             logger.info('Downloading {0}/{1}: "{name}" ({size}) [{date}]'.
-                        format(number+1, len(dllist), **link))
-        filename = '{friendlyname}.pqtmp'.format(**link)
+                        format(number+1, count, **link))
+        filename = self.outpath('{friendlyname}.pqtmp'.format(**link))
         link['filename'] = filename
-        delay()
-
-        browser.download_pq(link['url'], filename, _reporthook)
-
-        print('\r  > Done.')
-        if journal:
-            if not cparser.has_section('Log'):
-                cparser.add_section('Log')
-            cparser.set('Log', link['chkdelete'], link ['date'])
-            cparser.set('Log', link['chkdelete'], link ['date'])
+        self.delay()
 
-    delay()
-
-
-    class FilenameDict(object):
-        """A special dictionary for filename templates whose values depend on
-        the parameters given to the constructor (link and suffix).
-
-        """
-        def __init__(self, link, suffix):
-            """Inits the FilenameDict.
-
-            link -- dictionary with link template values
-            suffix -- the filename suffix, as example 'zip' or 'gpx'
-
-            """
-            self.suffix = suffix
-            self.link = link
-            self.base = self.single if opts.singlefile else self.basic
-
-        basic = {
-                'normal':'{mapstr}{chkdelete}_{friendlyname}_{date}',
-                'myfinds':'{mapstr}MyFinds_{date}',
-                'waypoints':('{mapstr}{chkdelete}_'
-                             '{friendlyname}_{date}_waypoints')
-                }
-
-        single = {
-                'normal':'{mapstr}{chkdelete}_{friendlyname}',
-                'myfinds':'{mapstr}MyFinds',
-                'waypoints':'{mapstr}{chkdelete}_{friendlyname}_waypoints'
-                }
-
-        def __getattr__(self, name):
-            return "%s.%s" % (self.base[name].format(**self.link), self.suffix)
-
-
-
-    logger = logging.getLogger('main.process')
-    logger.info("Processing downloaded files")
-    if dllist == []:
-        logger.info("No downloads to process")
-    for link in dllist:
-        template = FilenameDict(link, 'zip')
-        link['mapstr'] = (get_mapstr(mparser, link) + opts.sep if opts.mappings
-                          else '')
-        link['realfilename'] = template.normal
-        if os.path.isfile(link['realfilename']):
-            remove(link['realfilename'])
-        rename(link['filename'], link['realfilename'])
-
-    if opts.unzip:
+        key = (self.opts.username, link['chkdelete'])
+        self.progress.start(key, link['friendlyname'],
+                            parse_size(link['size']))
+        started = time.time()
+        self.event('download_started', link)
+        try:
+            browser.download_pq(link['url'], filename, self.events.hook(
+                self.progress.hook(key), link, account=self.opts.username))
+        except Exception, error:
+            self.progress.finish(key, failed=True)
+            self.event('download_failed', link, error=str(error))
+            if os.path.isfile(filename):
+                remove(filename)
+            raise
+        self.progress.finish(key)
+        size = os.path.getsize(filename)
+        self.event('download_finished', link, bytes=size,
+                   seconds=time.time() - started)
+        with self._lock:
+            self._dlbytes += size
+            self._dltime += time.time() - started
+        self.metrics.add('downloads')
+        self.metrics.add('bytes', size)
+
+    def process(self, links):
+        """Renames (and unzips and filters if enabled) downloaded PQs, yields
+        every PQ when it's done. link['realfilename'] is the ZIP file,
+        link['gpxfile'] and link['wptfile'] the unzipped files."""
+        opts = self.opts
+        cachefilter = (CacheFilter(opts.filter, self.sync) if opts.filter
+                       else None)
+        logger = logging.getLogger('main.process')
+        for link in links:
+            logger.debug("Processing %s", link['friendlyname'])
+            # Resumed PQs continue after their last completed stage
+            stage = link.get('stage', 'downloaded')
+            if stage == 'downloaded':
+                template = FilenameDict(link, 'zip', opts.singlefile)
+                link['mapstr'] = (get_mapstr(self.mparser, link) + opts.sep
+                                  if opts.mappings else '')
+                link['realfilename'] = self.outpath(template.normal)
+                if os.path.isfile(link['realfilename']):
+                    remove(link['realfilename'])
+                rename(link['filename'], link['realfilename'])
+                stage = self.checkpoint(link, 'renamed')
+                self.event('stored', link)
+
+            if opts.unzip and stage == 'renamed':
+                self.unzip(link)
+                if cachefilter and link.get('gpxfile'):
+                    cachefilter.apply(link['gpxfile'], link.get('wptfile'))
+                if opts.ggz and link.get('gpxfile'):
+                    template = FilenameDict(link, 'ggz', opts.singlefile)
+                    link['ggzfile'] = self.outpath(
+                        template.myfinds if link['chkdelete'] == 'myfinds'
+                        else template.normal)
+                    write_ggz([link['gpxfile']], link['ggzfile'], self.sync)
+                self.checkpoint(link, 'extracted')
+                self.event('extracted', link)
+                if not opts.keepzip:
+                    remove(link['realfilename'])
+            if opts.hooks:
+                if self.hooks is None:
+                    self.hooks = HookPipeline(
+                        opts.hooks, int(opts.hookworkers),
+                        int(opts.hookqueue), self.metrics, self.events,
+                        opts.username)
+                # Blocks while the hooks are behind
+                self.hooks.submit(link)
+            yield link
+
+    def unzip(self, link):
+        """Unzips a downloaded PQ and renames the files."""
         logger = logging.getLogger('main.unzip')
-        logger.info("Unzipping the downloaded files")
-        for link in dllist:
-            template = FilenameDict(link,'gpx')
-            logger.info("Unzipping {realfilename}".format(**link))
-
-            zfile = zipfile.ZipFile(link['realfilename'])
-            for info in zfile.infolist():
-                isinstance(info, zipfile.ZipInfo)
-                logger.debug("{filename} (size: {size})".
-                             format(filename=info.filename,
-                                    size=info.file_size))
-                zfile.extract(info)
-
-                if link['chkdelete'] == 'myfinds':
-                    filename = template.myfinds
-                else:
-                    filename = template.normal
-                if 'wpts' in info.filename:
-                    filename = template.waypoints
-                if info.filename != filename:
-                    if os.path.isfile(filename):
-                        remove(filename)
-                    rename(info.filename, filename)
+        template = FilenameDict(link, 'gpx', self.opts.singlefile)
+        logger.info("Unzipping {realfilename}".format(**link))
 
-            zfile.close()
+        zfile = zipfile.ZipFile(link['realfilename'])
+        for info in zfile.infolist():
+            logger.debug("%s (size: %d)", info.filename, info.file_size)
 
-            if not opts.keepzip:
-                remove(link['realfilename'])
+            if link['chkdelete'] == 'myfinds':
+                filename = template.myfinds
+            else:
+                filename = template.normal
+            if 'wpts' in info.filename:
+                filename = template.waypoints
+                link['wptfile'] = self.outpath(filename)
+            else:
+                link['gpxfile'] = self.outpath(filename)
+            # Extracted straight to the final name, see AtomicWriter
+            member = zfile.open(info)
+            try:
+                with AtomicWriter(self.outpath(filename),
+                                  self.sync) as outfile:
+                    shutil.copyfileobj(member, outfile,
+                                       AtomicWriter.BUFFER_SIZE)
+            finally:
+                member.close()
+
+        zfile.close()
+
+    def finish(self, dllist):
+        """Runs the steps that need all processed PQs (merge, index, online
+        removal) and writes the journal."""
+        opts = self.opts
+        if opts.unzip and opts.merge and dllist != []:
+            logger = logging.getLogger('main.merge')
+            logger.info("Merging the unzipped files into %s.gpx", opts.merge)
+            merge_gpx([(link['date'], link['gpxfile'], link.get('wptfile'))
+                       for link in dllist if link.get('gpxfile')],
+                      self.outpath('%s.gpx' % opts.merge),
+                      self.outpath('%s_waypoints.gpx' % opts.merge),
+                      self.sync)
+
+        if opts.unzip and opts.ggzcombine and dllist != []:
+            logger = logging.getLogger('main.ggz')
+            logger.info("Combining the unzipped files into %s.ggz",
+                        opts.ggzcombine)
+            write_ggz([link['gpxfile'] for link in
+                       sorted(dllist, key=lambda link:
+                              parse_pqdate(link['date']), reverse=True)
+                       if link.get('gpxfile')],
+                      self.outpath('%s.ggz' % opts.ggzcombine), self.sync)
+
+        if opts.unzip and opts.index and dllist != []:
+            logger = logging.getLogger('main.index')
+            logger.info("Updating the cache index %s", opts.indexfile)
+            index = CacheIndex(self.outpath(opts.indexfile))
+            try:
+                for link in dllist:
+                    if link.get('gpxfile'):
+                        index.update(link['gpxfile'], link['date'])
+            finally:
+                index.close()
+
+        if opts.remove:
+            self.remove_online([link for link in dllist
+                                if link.get('stage') != 'removed'])
+
+        if self.hooks is not None:
+            self.hooks.close()
+            self.hooks = None
+
+        self.sync.commit()
+        if opts.journal and self.journal is not None:
+            logger = logging.getLogger('main')
+            logger.debug("Writing journal file %s", opts.journalfile)
+            data = StringIO.StringIO()
+            self.journal.write(data)
+            write_atomic(self.outpath(opts.journalfile), data.getvalue())
+
+        self.clear_checkpoints(dllist)
+
+    def load_checkpoints(self):
+        """Reads the state file of an interrupted run."""
+        self.state = ConfigParser.RawConfigParser()
+        self.state.read([self.outpath(self.opts.statefile)])
+
+    def checkpoint(self, link, stage):
+        """Durably records that a PQ has completed a stage (downloaded,
+        renamed, extracted or removed). Returns the stage."""
+        link['stage'] = stage
+        # The files of the stage must be on disk before it's recorded
+        self.sync.commit()
+        if self.state is None:
+            return stage
+        section = link['chkdelete']
+        if not self.state.has_section(section):
+            self.state.add_section(section)
+        self.state.set(section, 'stage', stage)
+        self.state.set(section, 'link', link.to_json())
+        self._save_checkpoints()
+        return stage
+
+    def clear_checkpoints(self, links):
+        """Forgets finished PQs, removes the state file if it's empty."""
+        if self.state is None:
+            return
+        for link in links:
+            self.state.remove_section(link['chkdelete'])
+        self._save_checkpoints()
+
+    def _save_checkpoints(self):
+        """Writes the state file, see write_atomic()."""
+        path = self.outpath(self.opts.statefile)
+        if not self.state.sections():
+            if os.path.isfile(path):
+                remove(path)
+            return
+        data = StringIO.StringIO()
+        self.state.write(data)
+        write_atomic(path, data.getvalue())
+
+    def resumable(self, linklist, args=(), excludes=()):
+        """Returns the PQs of an interrupted run that can continue from
+        their last completed stage. PQs whose files are gone, that have been
+        generated again since or that don't match args and excludes (like
+        select()) any more are dropped from the state file."""
+        args, excludes = list(args), list(excludes)
+        logger = logging.getLogger('main.resume')
+        listed = dict((link['chkdelete'], link['date']) for link in linklist)
+        resumed = []
+        for section in self.state.sections():
+            link = PqRecord.from_json(self.state.get(section, 'link'))
+            stage = link['stage']
+            required = {'downloaded': link.get('filename'),
+                        'renamed': link.get('realfilename'),
+                        'extracted': link.get('gpxfile') or
+                                     link.get('realfilename'),
+                        'removed': link.get('gpxfile') or
+                                   link.get('realfilename')}.get(stage)
+            if listed.get(section, link['date']) != link['date']:
+                logger.info('"%s" has been generated again, the files of the '
+                            'interrupted run are ignored.', link['name'])
+            elif (check_linkmatch(link, excludes) or
+                  (args and not check_linkmatch(link, args))):
+                logger.info('"%s" is not resumed, it is excluded or not in '
+                            'the arguments list.', link['name'])
+            elif not required or not os.path.isfile(required):
+                logger.info('Files of "%s" are missing, it will be '
+                            'downloaded again.', link['name'])
+            else:
+                logger.info('Resuming "%s" after stage %s', link['name'],
+                            stage)
+                resumed.append(link)
+                continue
+            self.state.remove_section(section)
+        return resumed
 
-    if opts.remove:
+    def remove_online(self, dllist):
+        """Removes the given PQs from GC.com."""
+        opts = self.opts
         logger = logging.getLogger('main.removegc')
         logger.info("Removing downloaded files from GC.com")
         rmlist = []
@@ -976,30 +3493,169 @@ def main():
                 ctl = opts.ctl
             else:
                 logger.debug("Searching CTL value...")
-                ctl = browser.find_ctl()
-                logger.debug("Found value %s" % ctl)
+                ctl = self.browser.find_ctl()
+                logger.debug("Found value %s", ctl)
             logger.info("Sending removal request...")
-            browser.delete_pqs(rmlist, ctl)
+            self.browser.delete_pqs(rmlist, ctl)
+            for link in dllist:
+                if link['chkdelete'] in rmlist:
+                    self.checkpoint(link, 'removed')
+                    self.event('removed', link)
             logger.info("Removal request sent. If it didn't work, please report"
                         " this a bug. Groundspeak makes so many changes on "
                         "their site that this feature is broken from time "
                         "to time.")
 
+    def run(self, args=(), excludes=()):
+        """Lists, selects, downloads and processes the PQs like the command
+        line does (login() must have been called). Yields every PQ as soon
+        as it's processed and finishes the run afterwards."""
+        started = time.time()
+        self.load_journal()
+        self.load_checkpoints()
+        linklist = self.list_pqs()
+        if self.opts.myfinds:
+            self.browser.trigger_myfinds()
+        resumed = self.resumable(linklist, args, excludes)
+        resumedids = set(link['chkdelete'] for link in resumed)
+        # Resumed PQs are neither selected nor logged again
+        remaining = [link for link in linklist
+                     if link['chkdelete'] not in resumedids]
+        dllist = (self.select(remaining, args, excludes)
+                  if remaining or not linklist else [])
+        for link in resumed:
+            self.mark_journal(link)
+        if self.opts.list:
+            logging.getLogger('main.download').info("Downloads skipped!")
+            dllist = []
+            resumed = []
+        if dllist:
+            logging.getLogger('main.download').info(
+                "Downloading selected files")
+        done = []
+        for link in self.process(itertools.chain(
+                resumed, self.download(dllist, started))):
+            done.append(link)
+            yield link
+        self.delay()
+        self.finish(done)
+
+    def close(self):
+        """Closes the event stream if the session opened it."""
+        if self._ownevents:
+            self.events.close()
+
+
+def process_account(opts, args, excludes, limits, metrics, progress,
+                    events=None):
+    """Logs in, downloads and processes the PQs of one account. All files
+    are written to opts.outputdir.
+
+    limits, metrics, progress and events -- Limits, Metrics, Progress and
+                                            EventStream instances shared by
+                                            all accounts of the run
+
+    """
+    session = PqSession(opts=opts, limits=limits, metrics=metrics,
+                        progress=progress, eventstream=events)
+    session.login()
+    for link in session.run(args, excludes):
+        pass
+
+
+def run_account(name, opts, args, excludes, limits, metrics, progress,
+                events=None):
+    """Thread target for process_account() with multiple accounts. Errors
+    are logged and don't affect the other accounts."""
+    logger = logging.getLogger('main.account')
+    try:
+        process_account(opts, args, excludes, limits, metrics, progress,
+                        events)
+    except LoginError:
+        metrics.add('failed accounts')
+    except Exception:
+        logger.exception("Processing account %s failed", name)
+        metrics.add('failed accounts')
+
+
+def main():
+    """Main routine that contains the program logic."""
+    ### Parsing options
+    opts, args = optparse_setup()
+    # Logged after the setup, which may move the console log to stderr
+    logging.info("PQdl v%s (%s) by leoluk. Updates and help on "
+                 "www.leoluk.de/paperless-caching/pqdl" ,
+                 __version__, __status__)
+    global BASE_URL
+    BASE_URL = RAW_BASE_URL % ("s" if opts.allsecure else "")
+
+    if opts.netdebug:
+        import socks
+        import socket
+        socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, "127.0.0.1", 1080)
+        socket.socket = socks.socksocket
+
+    if opts.near or opts.bbox:
+        query_index(opts)
+        return
+
+    excludes = [arg[1:] for arg in args if arg[0] == '#']
+    args = [arg for arg in args if arg[0] != '#']
+
     logger = logging.getLogger('main')
-    if opts.journal:
+
+    if not opts.noupdate:
+        check_update(opts.nobrowser)
+    else:
+        logger.info("Update check skipped. Please check for updates yourself!")
+
+    logger.debug("mechanize %d.%d.%d; BeautifulSoup: %s; Filename: %s; "
+                 "Python: %s", mechanize.__version__[0],
+                 mechanize.__version__[1], mechanize.__version__[2],
+                 BeautifulSoup.__version__, os.path.basename(sys.argv[0]),
+                 sys.version)
+
+    limits = Limits(int(opts.connections), float(opts.ratelimit),
+                    Bandwidth.from_options(opts), CircuitBreaker())
+    metrics = Metrics()
+    progress = Progress(stream=console_stream(opts))
+    events = EventStream(opts.events)
+
+    if opts.accountlist:
+        # Show the account (thread name) in every console line
+        for handler in logging.root.handlers:
+            if not isinstance(handler, QueueHandler):
+                handler.setFormatter(logging.Formatter(
+                    "%(levelname)s - %(threadName)s - %(name)s -> "
+                    "%(message)s"))
+        threads = []
+        for name, aopts in account_options(opts):
+            logger.info("Starting account %s (%s)", name, aopts.username)
+            thread = threading.Thread(target=run_account, name=name,
+                                      args=(name, aopts, list(args),
+                                            list(excludes), limits, metrics,
+                                            progress, events))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    else:
         try:
-            logger.debug("Writing journal file %s" % opts.journalfile)
-            cfile = open(opts.journalfile, 'w')
-            cparser.write(cfile)
-        finally:
-            cfile.close()
+            process_account(opts, args, excludes, limits, metrics, progress,
+                            events)
+        except LoginError:
+            sys.exit(1)
+
+    metrics.log()
+    events.close()
 
     if opts.noexit:
-        raw_input('Press any key to exit.')
+        # raw_input() prompts on stdout, which belongs to --events -
+        stream = console_stream(opts)
+        stream.write('Press any key to exit.')
+        stream.flush()
+        raw_input()
 
 if __name__ == "__main__":
-    logging.info("PQdl v%s (%s) by leoluk. Updates and help on "
-                 "www.leoluk.de/paperless-caching/pqdl" ,
-                 __version__, __status__)
     main()
     logging.info("Done")